@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+"""Benchmarks for image loading, rendering and export.
+
+Runs headless on Cairo ImageSurfaces and prints machine-readable results
+(JSON). Pass a previous result file with C{--compare} to flag regressions.
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+import cairo
+
+import cairopresent
+from cairopresent.helpers import imageloader, layoutcache
+from cairopresent.helpers.resources import get_example
+
+import export
+
+
+DEFAULT_GEOMETRIES = [(640, 480), (1024, 768), (1920, 1080)]
+DEFAULT_REPEAT = 5
+REGRESSION_THRESHOLD = 1.10     # flag benchmarks that got 10% slower
+
+
+def timed(func, repeat, setup=None):
+    """Calls C{func} C{repeat} times and returns the durations in seconds.
+    C{setup} is called before each call and isn't timed."""
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+def clear_caches():
+    imageloader.image_cache.clear()
+    layoutcache.layout_cache.clear()
+
+
+class Fixtures(object):
+    """Generated and bundled input files for the benchmarks."""
+
+    def __init__(self, directory, size=(3000, 2000)):
+        self.directory = directory
+        self.png = os.path.join(directory, 'gradient.png')
+        self.jpg = os.path.join(directory, 'gradient.jpg')
+        self.bundled_jpg = os.path.join(cairopresent.helpers.resources.EXAMPLE_PATH,
+                                        'thp', '161547780_81e990d7f7_o.jpg')
+        self.lessig = get_example('lessig.txt')
+        self.generate(size)
+
+    def generate(self, size):
+        width, height = size
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+        cr = cairo.Context(surface)
+        gradient = cairo.LinearGradient(0, 0, width, height)
+        gradient.add_color_stop_rgb(0, .1, .3, .6)
+        gradient.add_color_stop_rgb(1, .9, .6, .2)
+        cr.set_source(gradient)
+        cr.paint()
+        for i in range(0, width, 50):
+            cr.arc(i, (i * 7) % height, 40, 0, 6.283)
+            cr.set_source_rgba(1, 1, 1, .3)
+            cr.fill()
+        surface.write_to_png(self.png)
+
+        import Image
+        Image.open(self.png).convert('RGB').save(self.jpg, quality=90)
+
+    def thp_presentation(self):
+        slides = [(self.png, "Generated PNG"),
+                  (self.jpg, "Generated\nJPEG"),
+                  (self.bundled_jpg, "A History of\nComputing Machinery")]
+        return cairopresent.render.thp.Presentation(slides)
+
+    def lessig_presentation(self):
+        return cairopresent.render.lessig.Presentation(self.lessig)
+
+
+class Benchmark(object):
+    """Collects the results of a benchmark run."""
+
+    def __init__(self, repeat, only=None):
+        self.repeat = repeat
+        self.only = only
+        self.results = []
+
+    def run(self, name, func, setup=None, geometry=None, repeat=None):
+        if self.only and self.only not in name:
+            return
+        durations = timed(func, repeat or self.repeat, setup)
+        durations.sort()
+        result = {'name': name,
+                  'geometry': geometry and list(geometry),
+                  'repeat': len(durations),
+                  'min': durations[0],
+                  'median': durations[len(durations) // 2],
+                  'mean': sum(durations) / len(durations)}
+        self.results.append(result)
+        print >> sys.stderr, '%-50s %9.2f ms' % (result_key(result),
+                                                 1000 * result['median'])
+
+    def report(self):
+        return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'platform': platform.platform(),
+                         'python': platform.python_version(),
+                         'cairo': cairo.cairo_version_string(),
+                         'repeat': self.repeat},
+                'results': self.results}
+
+
+def result_key(result):
+    if result['geometry']:
+        return '%s@%dx%d' % (result['name'], result['geometry'][0],
+                             result['geometry'][1])
+    return result['name']
+
+def bench_loaders(bench, fixtures):
+    bench.run('load/png/cairo',
+              lambda: imageloader.image_surface_with_cairo(fixtures.png))
+    bench.run('load/png/pil',
+              lambda: imageloader.image_surface_with_pil(fixtures.png))
+    bench.run('load/jpg/pil',
+              lambda: imageloader.image_surface_with_pil(fixtures.jpg))
+    bench.run('load/png/sniffed',
+              lambda: imageloader.load(fixtures.png))
+    bench.run('load/jpg/sniffed',
+              lambda: imageloader.load(fixtures.jpg))
+    bench.run('load/jpg/cached',
+              lambda: imageloader.cached_image_surface(fixtures.jpg))
+
+def bench_scaling(bench, fixtures, geometries):
+    source = imageloader.image_surface_with_pil(fixtures.jpg)
+    iw, ih = source.get_width(), source.get_height()
+    for width, height in geometries:
+        target = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        sf = max(float(width) / iw, float(height) / ih)
+
+        def paint_full():
+            cr = cairo.Context(target)
+            cr.scale(sf, sf)
+            cr.set_source_surface(source, 0, 0)
+            cr.paint()
+
+        def paint_pyramid():
+            surface, lx, ly = imageloader.scaled_image_surface(fixtures.jpg, sf)
+            cr = cairo.Context(target)
+            cr.scale(sf / lx, sf / ly)
+            cr.set_source_surface(surface, 0, 0)
+            cr.paint()
+
+        bench.run('paint/full-resolution', paint_full, geometry=(width, height))
+        bench.run('paint/pyramid', paint_pyramid, geometry=(width, height))
+
+def bench_layout(bench, fixtures, geometries):
+    presentation = fixtures.lessig_presentation()
+    for width, height in geometries:
+        bench.run('layout/lessig/cold',
+                  lambda: layoutcache.preshape(presentation, width, height),
+                  setup=clear_caches, geometry=(width, height))
+        bench.run('layout/lessig/warm',
+                  lambda: layoutcache.preshape(presentation, width, height),
+                  geometry=(width, height))
+
+def bench_render(bench, fixtures, geometries):
+    presentations = [('thp', fixtures.thp_presentation()),
+                     ('lessig', fixtures.lessig_presentation())]
+    for width, height in geometries:
+        target = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        for style, presentation in presentations:
+            def render():
+                for slide in presentation.slides:
+                    cr = cairo.Context(target)
+                    presentation.renderer.render_slide(cr, width, height, slide)
+            bench.run('render/%s/cold' % style, render,
+                      setup=clear_caches, geometry=(width, height))
+            bench.run('render/%s/warm' % style, render,
+                      geometry=(width, height))
+
+def bench_export(bench, fixtures, geometries, directory):
+    presentation = fixtures.thp_presentation()
+    basename = os.path.join(directory, 'export')
+    exporters = [('pdf', lambda g: export.PDFExport(presentation, basename + '.pdf', g)),
+                 ('svg', lambda g: export.SVGExport(presentation, basename, g)),
+                 ('png', lambda g: export.PNGExport(presentation, basename, g)),
+                 ('jpg', lambda g: export.PILExport(presentation, 'jpg', basename, g))]
+    for geometry in geometries:
+        for name, make in exporters:
+            bench.run('export/%s' % name, lambda: make(geometry).render(),
+                      setup=clear_caches, geometry=geometry,
+                      repeat=max(1, bench.repeat // 2))
+
+def compare(old, new, threshold=REGRESSION_THRESHOLD):
+    """Prints the median ratio of C{new} to C{old} results.
+
+    @return: The number of regressions above C{threshold}.
+    """
+    old_results = dict((result_key(r), r) for r in old['results'])
+    regressions = 0
+    for result in new['results']:
+        key = result_key(result)
+        if key not in old_results:
+            continue
+        ratio = result['median'] / max(old_results[key]['median'], 1e-9)
+        flag = ''
+        if ratio > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print >> sys.stderr, '%-50s %6.2fx%s' % (key, ratio, flag)
+    return regressions
+
+def parse_geometry(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', default=DEFAULT_REPEAT,
+                      help='timed runs per benchmark [%default]')
+    parser.add_option('-g', '--geometry', action='append', default=[],
+                      help='WIDTHxHEIGHT, may be given several times')
+    parser.add_option('-o', '--output', help='write JSON results to this file')
+    parser.add_option('-c', '--compare', help='JSON results of an earlier run')
+    parser.add_option('-k', '--only', help='run benchmarks containing this string')
+    options, args = parser.parse_args()
+
+    geometries = map(parse_geometry, options.geometry) or DEFAULT_GEOMETRIES
+    directory = tempfile.mkdtemp(prefix='cairopresent-bench-')
+    try:
+        fixtures = Fixtures(directory)
+        bench = Benchmark(options.repeat, options.only)
+        bench_loaders(bench, fixtures)
+        bench_scaling(bench, fixtures, geometries)
+        bench_layout(bench, fixtures, geometries)
+        bench_render(bench, fixtures, geometries)
+        bench_export(bench, fixtures, geometries, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    report = bench.report()
+    if options.output:
+        f = open(options.output, 'w')
+        json.dump(report, f, indent=2)
+        f.close()
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print
+
+    if options.compare:
+        f = open(options.compare)
+        old = json.load(f)
+        f.close()
+        if compare(old, report):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
-__all__ = ['imageloader', 'resources']
+__all__ = ['assets', 'decks', 'diskcache', 'imageloader', 'layoutcache', 'prefetch', 'profiling', 'resources', 'slidecache', 'slidesource', 'transition']
 
-from . import imageloader, resources
\ No newline at end of file
+from . import assets, diskcache, imageloader, layoutcache, prefetch, profiling, resources, slidecache, slidesource, transition
+from . import decks
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""Checking the images of a deck before it is shown or exported.
+
+C{probe_assets} reads only the headers of all images a presentation refers
+to, on a pool of threads, so a missing or corrupt file is reported when the
+deck is loaded instead of when its slide comes up. The image sizes found are
+handed to the shared image cache, so slide geometry can be computed without
+decoding any pixels.
+"""
+
+from multiprocessing.pool import ThreadPool
+
+from cairopresent.helpers import imageloader
+
+DEFAULT_PROBE_WORKERS = 8
+
+
+class AssetReport(object):
+    """The result of C{probe_assets}."""
+
+    def __init__(self):
+        self.infos = {}     # path -> imageloader.ImageInfo
+        self.errors = []    # (path, slide indices, message)
+        self.slides = {}    # path -> indices of the slides showing it
+
+    def format_errors(self):
+        """Returns one line per broken asset, listing the (1-based) slides
+        that show it."""
+        return '\n'.join('%s (slide %s): %s' % (path,
+                                                ', '.join(str(index + 1) for index in indices),
+                                                message)
+                         for path, indices, message in self.errors)
+
+
+def _probe(path):
+    try:
+        return path, imageloader.probe(path), None
+    except (IOError, OSError), e:
+        return path, None, str(e)
+
+def probe_assets(presentation, workers=DEFAULT_PROBE_WORKERS,
+                 cache=imageloader.image_cache):
+    """Probes every image shown by C{presentation}.
+
+    @type  workers: int
+    @param workers: Number of threads reading headers in parallel.
+    @param cache:   C{ImageCache} to store the image sizes in, or C{None}.
+    @rtype:         L{AssetReport}
+    """
+    report = AssetReport()
+    renderer = presentation.renderer
+    for index, slide in enumerate(presentation.slides):
+        for path in renderer.slide_assets(slide):
+            report.slides.setdefault(path, []).append(index)
+
+    pool = ThreadPool(max(1, min(workers, len(report.slides))))
+    try:
+        for path, info, error in pool.imap_unordered(_probe, report.slides):
+            if error is None:
+                report.infos[path] = info
+                if cache is not None:
+                    cache.set_size(path, (info.width, info.height))
+            else:
+                report.errors.append((path, report.slides[path], error))
+    finally:
+        pool.close()
+        pool.join()
+    report.errors.sort(key=lambda error: error[1])
+    return report
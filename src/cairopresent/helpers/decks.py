@@ -0,0 +1,47 @@
+"""Loading presentations from deck files.
+
+Lessig style decks are plain text files (see C{examples/lessig}). thpani
+style decks are JSON files holding C{{"style": "thp", "slides": [[bg, text],
+...]}}, with background paths relative to the JSON file, or JSON lines files
+(C{.jsonl}) holding one C{[bg, text]} array per line. Text and JSON lines
+decks are loaded lazily, so even huge decks open instantly.
+"""
+
+import json
+import os
+
+from cairopresent.render import lessig, thp
+
+
+def load(filename):
+    """Creates the presentation stored in C{filename}.
+
+    @type  filename: string
+    @param filename: Path to a C{.txt} (Lessig), C{.json} or C{.jsonl}
+                     (thpani) deck.
+    """
+    if filename.lower().endswith('.jsonl'):
+        return thp.Presentation(thp.SlideFile(filename))
+    elif filename.lower().endswith('.json'):
+        f = open(filename)
+        spec = json.load(f)
+        f.close()
+        return from_spec(spec, os.path.dirname(filename))
+    return lessig.Presentation(filename)
+
+def from_spec(spec, base_dir='.'):
+    """Creates a presentation from a deck description.
+
+    @type  spec:     dict
+    @param spec:     C{{"style": "thp", "slides": [[bg, text], ...]}} or
+                     C{{"style": "lessig", "path": filename}}.
+    @type  base_dir: string
+    @param base_dir: Directory relative paths are resolved against.
+    """
+    style = spec.get('style', 'thp')
+    if style == 'lessig':
+        return lessig.Presentation(os.path.join(base_dir, spec['path']))
+    elif style == 'thp':
+        slides = [(os.path.join(base_dir, bg), text) for bg, text in spec['slides']]
+        return thp.Presentation(slides)
+    raise ValueError("unknown presentation style %r" % style)
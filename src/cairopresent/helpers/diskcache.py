@@ -0,0 +1,266 @@
+"""Persistent on-disk cache of rendered slide rasters.
+
+Slides are stored as raw, native-endian C{FORMAT_ARGB32} pixel data, one
+file per slide and geometry, and loaded by memory-mapping the file into a
+cairo ImageSurface, so there is nothing to decode.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import Queue
+import tempfile
+import threading
+import time
+import traceback
+
+import cairo
+
+FORMAT_VERSION = 1
+DEFAULT_DISK_CACHE_BYTES = 1024 * 1024 * 1024
+DEFAULT_DISK_CACHE_DIR = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+        'cairopresent', 'slides')
+STALE_TEMP_AGE = 3600   # seconds after which shrink() deletes leftover temp files
+SHRINK_EVERY = 16       # put() shrinks after writing max_bytes / SHRINK_EVERY
+DEFAULT_MAX_PENDING = 4 # slides a DiskCacheWriter holds before dropping more
+
+
+def asset_key(path):
+    """Returns C{[path, mtime, size]} of an image, with C{None} for mtime
+    and size if it doesn't exist."""
+    try:
+        st = os.stat(path)
+        return [path, st.st_mtime, st.st_size]
+    except OSError:
+        return [path, None, None]
+
+def slide_key(renderer, slide, geometry):
+    """Returns what the rendering of C{slide} depends on: a hash of the
+    slide, mtime and size of the images it shows (see L{asset_key}), the
+    renderer and the geometry.
+
+    @rtype: dict
+    """
+    name = getattr(renderer, '__name__', None) or type(renderer).__name__
+    return {'slide': hashlib.sha1(renderer.slide_key(slide)).hexdigest(),
+            'assets': [asset_key(path) for path in renderer.slide_assets(slide)],
+            'renderer': '%s.%s' % (renderer.__module__, name),
+            'geometry': list(geometry)}
+
+
+class DiskCache(object):
+    """A size-limited directory of rendered slide rasters.
+
+    The least recently used files are deleted once the directory holds more
+    than C{max_bytes}.
+    """
+
+    def __init__(self, directory=DEFAULT_DISK_CACHE_DIR,
+                 max_bytes=DEFAULT_DISK_CACHE_BYTES):
+        """Creates a disk cache.
+
+        @type  directory: string
+        @param directory: Cache directory; created when needed.
+        @type  max_bytes: int
+        @param max_bytes: Size limit of the directory.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self._unshrunk = 0  # bytes written since the last shrink()
+
+    def filename(self, renderer, slide, geometry):
+        """Returns the cache file of C{slide} rendered at C{geometry}."""
+        key = slide_key(renderer, slide, geometry)
+        key['version'] = FORMAT_VERSION
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+        return os.path.join(self.directory, '%s-%dx%d.argb32' % (
+                digest, geometry[0], geometry[1]))
+
+    def get(self, renderer, slide, geometry):
+        """Returns the cached raster of C{slide} at C{geometry} as an
+        ImageSurface backed by a private memory map, or C{None}."""
+        filename = self.filename(renderer, slide, geometry)
+        width, height = geometry
+        stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_ARGB32, width)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            self.misses += 1
+            return None
+        try:
+            if os.fstat(f.fileno()).st_size != stride * height:
+                self.misses += 1
+                return None
+            # ACCESS_COPY: drawing onto the surface doesn't touch the file
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        finally:
+            f.close()
+        try:
+            os.utime(filename, None)    # mark as recently used
+        except OSError:
+            pass    # deleted by shrink() meanwhile; the private map stays valid
+        self.hits += 1
+        return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32,
+                                                  width, height, stride)
+
+    def put(self, renderer, slide, geometry, surface):
+        """Stores the C{FORMAT_ARGB32} raster of C{slide} at C{geometry}."""
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass    # created by another thread or process meanwhile
+        filename = self.filename(renderer, slide, geometry)
+        surface.flush()
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        written = False
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(surface.get_data())
+            finally:
+                f.close()
+            os.rename(temp, filename)
+            written = True
+        finally:
+            if not written:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+        self.writes += 1
+        # listing the directory is costly, so shrink now and then; the
+        # budget is exceeded by at most 1/SHRINK_EVERY per process
+        self._unshrunk += surface.get_stride() * surface.get_height()
+        if self._unshrunk * SHRINK_EVERY >= self.max_bytes:
+            self.shrink()
+
+    def shrink(self, max_bytes=None):
+        """Deletes the least recently used files until the directory holds at
+        most C{max_bytes} (defaults to C{self.max_bytes}), and temp files
+        left behind by writes that were interrupted."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        self._unshrunk = 0
+        files = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if not name.endswith(('.argb32', '.tmp')):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.tmp'):
+                if now - st.st_mtime > STALE_TEMP_AGE:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        """Returns a dict of cache statistics."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'writes': self.writes, 'directory': self.directory,
+                'max_bytes': self.max_bytes}
+
+    def prewarm(self, presentation, geometry, progress=None):
+        """Renders all slides of C{presentation} at C{geometry} that aren't
+        cached yet. A slide that fails to render is skipped.
+
+        @param progress: Optional callable receiving C{(index, rendered)},
+                         where C{rendered} is C{None} if the slide failed.
+        @rtype:          tuple
+        @return:         The number of slides rendered, and
+                         C{(index, traceback)} for each slide that failed.
+        """
+        width, height = geometry
+        rendered = 0
+        errors = []
+        for index, slide in enumerate(presentation.slides):
+            filename = self.filename(presentation.renderer, slide, geometry)
+            if os.path.exists(filename):
+                os.utime(filename, None)
+                done = False
+            else:
+                try:
+                    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+                    cr = cairo.Context(surface)
+                    presentation.renderer.render_slide(cr, width, height, slide)
+                    self.put(presentation.renderer, slide, geometry, surface)
+                except Exception:
+                    errors.append((index, traceback.format_exc()))
+                    done = None
+                else:
+                    rendered += 1
+                    done = True
+            if progress is not None:
+                progress(index, done)
+        return rendered, errors
+
+
+class DiskCacheWriter(object):
+    """Writes slides to a L{DiskCache} on a single worker thread, so the
+    renderers don't wait for the disk.
+
+    At most C{max_pending} slides wait to be written; further ones are
+    dropped, as the disk cache is only a cache.
+    """
+
+    def __init__(self, cache, max_pending=DEFAULT_MAX_PENDING):
+        """Creates a writer and starts its worker thread.
+
+        @type  cache:       L{DiskCache}
+        @type  max_pending: int
+        @param max_pending: Number of slides waiting to be written.
+        """
+        self.cache = cache
+        self.dropped = 0
+        self.failed = 0
+        self._queue = Queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._work, name='disk-cache-write')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, renderer, slide, geometry, surface):
+        """Queues the raster of C{slide} at C{geometry} for writing, see
+        L{DiskCache.put}. Returns at once."""
+        try:
+            self._queue.put_nowait((renderer, slide, geometry, surface))
+        except Queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Writes the pending slides and stops the worker thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                self.cache.put(*job)
+            except Exception:
+                traceback.print_exc()
+                self.failed += 1
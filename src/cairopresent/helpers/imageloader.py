@@ -1,16 +1,28 @@
 """ImageSurface loading routines."""
 
 import array
+import math
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
 
 import cairo
 
+from cairopresent.helpers import profiling
+
 ##
-# image load/paint performance
-#   png w/ cairo: 0.70/0.06
-#   png w/ pil: 1.04/0.08
-#   jpg w/ pil: 0.85/0.06
+# image load/paint performance: run benchmark.py (load/* and paint/*)
 ##
 
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024 # memory budget of the shared image cache
+
+# pycairo before 1.12 has neither the constant nor Surface.set_mime_data;
+# resampled images then just aren't tagged (see ImageCache.get)
+MIME_TYPE_UNIQUE_ID = getattr(cairo, 'MIME_TYPE_UNIQUE_ID', None)
+
 def image_surface_with_cairo(filename):
     """Create a Cairo ImageSurface using Cairo's built-in PNG support.
     C{filename} must point to a PNG file.
@@ -21,26 +33,596 @@ def image_surface_with_cairo(filename):
     
     return cairo.ImageSurface.create_from_png(filename)
     
-def image_surface_with_pil(filename):
+def image_surface_with_pil(filename, target_size=None):
     """Create a Cairo ImageSurface using PIL.
     C{filename} must be loadable by PIL.
     
-    @type  filename: string
-    @param filename: path to image file 
+    JPEG files are decoded at 1/2, 1/4 or 1/8 of their size if that still
+    covers C{target_size}, which is considerably faster and needs a fraction
+    of the memory. Other formats are always decoded at full size.
+    
+    @type  filename:    string
+    @param filename:    path to image file 
+    @type  target_size: tuple
+    @param target_size: C{(width, height)} the image is shown at, if known
     """
     
     import Image
     
     image = Image.open(filename)
+    if target_size is not None:
+        # picks the largest DCT scaling that keeps both sides >= target_size
+        image.draft(image.mode, target_size)
+    return image_surface_from_pil(image)
+
+def image_surface_from_pil(image):
+    """Create a Cairo ImageSurface from a PIL image.
+    
+    Images with transparency become premultiplied C{FORMAT_ARGB32} surfaces,
+    all others become C{FORMAT_RGB24} surfaces. If NumPy is available, the
+    pixels are written straight into the surface's buffer.
+    
+    @param image: PIL image of any mode
+    """
+    
+    if image.mode == 'P':
+        image = image.convert('transparency' in image.info and 'RGBA' or 'RGB')
+    elif image.mode not in ('L', 'LA', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    has_alpha = image.mode in ('LA', 'RGBA') and image.getextrema()[-1] != (255, 255)
+    
+    try:
+        import numpy
+    except ImportError:
+        return _surface_from_pil_with_cairo(image, has_alpha)
+    return _surface_from_pil_with_numpy(numpy, image, has_alpha)
+
+# byte offsets of the channels in a native-endian cairo pixel
+if sys.byteorder == 'little':
+    _B, _G, _R, _A = range(4)
+    _RAW_RGB24 = 'BGRX'
+else:
+    _A, _R, _G, _B = range(4)
+    _RAW_RGB24 = 'XRGB'
+
+def _surface_from_pil_with_numpy(numpy, image, has_alpha):
+    width, height = image.size
+    format = has_alpha and cairo.FORMAT_ARGB32 or cairo.FORMAT_RGB24
+    surface = cairo.ImageSurface(format, width, height)
+    stride = surface.get_stride()
+    
+    # view of the surface's pixels as (height, width, 4) bytes
+    pixels = numpy.ndarray((height, width, 4), numpy.uint8, surface.get_data(),
+                           strides=(stride, 4, 1))
+    source = numpy.asarray(image)
+    if source.ndim == 2:
+        source = source[..., numpy.newaxis]     # mode L
+    
+    if image.mode in ('L', 'LA'):
+        channels = ((_R, 0), (_G, 0), (_B, 0))
+    else:
+        channels = ((_R, 0), (_G, 1), (_B, 2))
+    if has_alpha:
+        alpha = source[..., -1].astype(numpy.uint16)
+        for offset, channel in channels:
+            pixels[..., offset] = (source[..., channel] * alpha + 127) // 255
+        pixels[..., _A] = source[..., -1]
+    else:
+        for offset, channel in channels:
+            pixels[..., offset] = source[..., channel]
+    
+    surface.mark_dirty()
+    return surface
+
+def _tobytes(image, rawmode, stride):
+    tobytes = getattr(image, 'tobytes', None) or image.tostring
+    return tobytes('raw', rawmode, stride)
+
+def _surface_from_pil_with_cairo(image, has_alpha):
     width, height = image.size
     
-    # swap B and R channel
-    # TODO: why do we need this?!
-    if image.mode == 'RGB':
-        r, g, b = image.split()
-        image = Image.merge('RGB', (b, g, r))
-    image = image.convert('RGBA')
+    color = image.mode == 'RGB' and image or image.convert('RGB')
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_RGB24, width)
+    data = array.array('c', _tobytes(color, _RAW_RGB24, stride))
+    surface = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_RGB24,
+                                                 width, height, stride)
+    if not has_alpha:
+        return surface
     
-    data = array.array('c', image.tostring())
-    return cairo.ImageSurface.create_for_data(data, cairo.FORMAT_ARGB32,
-                                              width, height, width * 4)
+    # let cairo premultiply: paint the colors through the alpha channel
+    stride = cairo.ImageSurface.format_stride_for_width(cairo.FORMAT_A8, width)
+    data = array.array('c', _tobytes(image.split()[-1], 'L', stride))
+    mask = cairo.ImageSurface.create_for_data(data, cairo.FORMAT_A8,
+                                              width, height, stride)
+    premultiplied = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+    cr = cairo.Context(premultiplied)
+    cr.set_source_surface(surface, 0, 0)
+    cr.mask_surface(mask, 0, 0)
+    return premultiplied
+
+# leading bytes of the formats we tell apart, see sniff()
+_MAGIC = [('\x89PNG\r\n\x1a\n', 'PNG'),
+          ('\xff\xd8\xff', 'JPEG'),
+          ('GIF87a', 'GIF'), ('GIF89a', 'GIF'),
+          ('II*\x00', 'TIFF'), ('MM\x00*', 'TIFF'),
+          ('BM', 'BMP')]
+MAGIC_BYTES = 16    # header bytes sniff() needs
+
+def sniff(header):
+    """Returns the format of an image file from its first C{MAGIC_BYTES}
+    bytes, e.g. C{"PNG"} or C{"JPEG"}, or C{None} if it is unknown."""
+
+    for magic, format in _MAGIC:
+        if header.startswith(magic):
+            return format
+    if header[:4] == 'RIFF' and header[8:12] == 'WEBP':
+        return 'WEBP'
+    return None
+
+
+class Decoder(object):
+    """An entry of the decoder registry used by L{load}.
+
+    Each decoder measures its cost in seconds per megapixel of decoded
+    output, separately for every format, and C{load} picks the cheapest
+    decoder for a file's format. Until a decoder has decoded a format, its
+    C{cost} estimate is used.
+    """
+
+    def __init__(self, name, formats, decode, cost):
+        """Creates a decoder.
+
+        @type  name:    string
+        @param name:    Shown in L{decoder_stats}.
+        @type  formats: tuple
+        @param formats: Formats (see L{sniff}) the decoder handles, C{None}
+                        for any format, including unknown ones.
+        @param decode:  Callable taking C{(filename, target_size)} and
+                        returning an ImageSurface. May raise ImportError if
+                        an optional dependency is missing.
+        @type  cost:    float
+        @param cost:    Estimated seconds per megapixel.
+        """
+        self.name = name
+        self.formats = formats
+        self.decode = decode
+        self.cost = cost
+        self.available = True
+        self.stats = {}     # format -> [calls, seconds, megapixels]
+
+    def handles(self, format):
+        return self.available and (self.formats is None or format in self.formats)
+
+    def estimate(self, format):
+        """Returns the measured (or else estimated) seconds per megapixel
+        for C{format}."""
+        calls, seconds, megapixels = self.stats.get(format, (0, 0., 0.))
+        if megapixels > 0:
+            return seconds / megapixels
+        return self.cost
+
+    def __call__(self, filename, target_size, format):
+        start = time.time()
+        surface = self.decode(filename, target_size)
+        elapsed = time.time() - start
+        with _decoders_lock:
+            stats = self.stats.setdefault(format, [0, 0., 0.])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += surface.get_width() * surface.get_height() / 1e6
+        return surface
+
+_decoders = []
+_decoders_lock = threading.Lock()
+
+def register_decoder(decoder):
+    """Adds a L{Decoder} to the registry used by L{load}."""
+    with _decoders_lock:
+        _decoders.append(decoder)
+
+def decoder_stats():
+    """Returns C{{decoder name: {format: (calls, seconds per megapixel)}}}."""
+    with _decoders_lock:
+        return dict((decoder.name,
+                     dict((format, (calls, megapixels and seconds / megapixels))
+                          for format, (calls, seconds, megapixels) in decoder.stats.items()))
+                    for decoder in _decoders)
+
+def load(filename, target_size=None):
+    """Create a Cairo ImageSurface using the cheapest decoder for the format
+    of C{filename}, as told by its leading bytes (see L{sniff}).
+
+    @type  filename:    string
+    @param filename:    path to image file
+    @type  target_size: tuple
+    @param target_size: C{(width, height)} the image is shown at; the
+                        returned surface may be smaller than the full
+                        resolution image, but never smaller than this.
+    @raise IOError:     if no decoder can read the file.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        format = sniff(f.read(MAGIC_BYTES))
+    finally:
+        f.close()
+    with _decoders_lock:
+        candidates = sorted([decoder for decoder in _decoders if decoder.handles(format)],
+                            key=lambda decoder: decoder.estimate(format))
+    for decoder in candidates:
+        try:
+            return decoder(filename, target_size, format)
+        except ImportError:
+            decoder.available = False   # optional dependency missing
+    raise IOError("no decoder for %s (%s)" % (filename, format or 'unknown format'))
+
+def _decode_with_cairo(filename, target_size):
+    return image_surface_with_cairo(filename)
+
+# rough estimates, replaced by measurements once a decoder has run
+register_decoder(Decoder('cairo', ('PNG',), _decode_with_cairo, .02))
+register_decoder(Decoder('pil', None, image_surface_with_pil, .05))
+
+# PNG colour types as PIL modes
+_PNG_MODES = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}
+
+class ImageInfo(object):
+    """Format, size and colour mode of an image file, see L{probe}."""
+
+    __slots__ = ('format', 'width', 'height', 'mode')
+
+    def __init__(self, format, width, height, mode):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.mode = mode
+
+    def __repr__(self):
+        return 'ImageInfo(%r, %d, %d, %r)' % (self.format, self.width,
+                                             self.height, self.mode)
+
+def probe(filename):
+    """Reads the header of an image file, without decoding any pixels.
+
+    @rtype:  L{ImageInfo}
+    @raise IOError: if the file is missing, unreadable or not an image.
+    """
+
+    f = open(filename, 'rb')
+    try:
+        header = f.read(26)
+    finally:
+        f.close()
+    if sniff(header) == 'PNG':
+        if len(header) < 26 or header[12:16] != 'IHDR':
+            raise IOError("truncated PNG header: %s" % filename)
+        width, height = struct.unpack('>II', header[16:24])
+        mode = _PNG_MODES.get(ord(header[25]))
+        if not width or not height or mode is None:
+            raise IOError("corrupt PNG header: %s" % filename)
+        return ImageInfo('PNG', width, height, mode)
+    try:
+        import Image
+    except ImportError:
+        raise IOError("can't identify %s without PIL" % filename)
+    image = Image.open(filename)    # only reads the header
+    return ImageInfo(image.format, image.size[0], image.size[1], image.mode)
+
+def image_header_size(filename):
+    """Returns C{(width, height)} of an image file without decoding it.
+
+    @rtype: tuple
+    @return: The size, or C{None} if the file can't be identified.
+    """
+
+    try:
+        info = probe(filename)
+    except IOError:
+        return None
+    return info.width, info.height
+
+def level_size(width, height, level):
+    """Returns the size of pyramid level C{level} of a C{width} x C{height}
+    image. Matches the size of a JPEG decoded at a scale of 1/2**level."""
+    for i in range(level):
+        width, height = max(1, (width + 1) // 2), max(1, (height + 1) // 2)
+    return width, height
+
+
+class ImageCache(object):
+    """A cache of decoded image surfaces.
+
+    Surfaces are keyed by path, modification time and file size, so a file
+    that changes on disk is decoded again. Once the cache holds more than
+    C{max_bytes}, the least recently used surfaces are evicted.
+
+    Besides the decoded image (level 0), the cache keeps a pyramid of
+    downscaled copies: level C{n} is half the size of level C{n-1}. Use
+    C{get_scaled} to get the smallest level that still covers a given
+    scale factor, or C{get_sized} for a copy resampled to an exact size.
+    Levels are built from the closest cached level below; if there is
+    none, the loader is asked for the level's size, so a JPEG shown small
+    is never decoded at full resolution.
+
+    The cache may be shared between threads.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, loader=load):
+        """Creates an image cache.
+
+        @type  max_bytes: int
+        @param max_bytes: Memory budget for decoded pixel data.
+        @param loader:    Callable creating a surface from a filename and
+                          an optional C{target_size} hint; see
+                          L{load}.
+        """
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self._entries = OrderedDict()    # (file key, level) -> surface, oldest first
+        self._keys = {}                  # path -> current file key
+        self._sizes = {}                 # file key -> size of level 0
+        self._lock = threading.RLock()
+
+    def key(self, filename):
+        """Returns the cache key for C{filename}."""
+        st = os.stat(filename)
+        return (os.path.abspath(filename), st.st_mtime, st.st_size)
+
+    def get(self, filename, level=0):
+        """Returns the decoded surface for C{filename}, loading it on a miss.
+
+        @type  level: int or tuple
+        @param level: Pyramid level; each level halves width and height.
+                      A C{(width, height)} tuple asks for a copy resampled
+                      to exactly that size, tagged with a
+                      C{MIME_TYPE_UNIQUE_ID} derived from the file's path,
+                      mtime, size and the copy's size if pycairo supports
+                      it.
+        """
+        key = self.key(filename)
+        with self._lock:
+            surface = self._entries.pop((key, level), None)
+            if surface is not None:
+                self._entries[(key, level)] = surface    # mark as most recently used
+                self.hits += 1
+                return surface
+            self.misses += 1
+
+        # decode/scale outside the lock, so other threads may hit meanwhile
+        if level == 0:
+            with profiling.phase(profiling.DECODE):
+                surface = self.loader(filename)
+            profiling.allocated(profiling.DECODE, surface_bytes(surface))
+        elif isinstance(level, tuple):
+            width, height = level
+            iw, ih = self.size(filename)
+            parent = self.get_scaled(filename, max(float(width) / iw,
+                                                   float(height) / ih))[0]
+            with profiling.phase(profiling.SCALE):
+                surface = scale_surface(parent, width, height)
+            profiling.allocated(profiling.SCALE, surface_bytes(surface))
+            # vector backends embed surfaces with equal ids once, so a copy
+            # made again after eviction isn't embedded a second time
+            if MIME_TYPE_UNIQUE_ID is not None:
+                surface.set_mime_data(MIME_TYPE_UNIQUE_ID,
+                                      '%r-%dx%d' % (key, width, height))
+        else:
+            surface = self._decode(filename, key, level)
+            if surface is None:
+                parent = self.get(filename, level - 1)
+                with profiling.phase(profiling.SCALE):
+                    surface = scale_surface(parent, max(1, (parent.get_width() + 1) // 2),
+                                                    max(1, (parent.get_height() + 1) // 2))
+                profiling.allocated(profiling.SCALE, surface_bytes(surface))
+        self.put((key, level), surface)
+        return surface
+
+    def size(self, filename):
+        """Returns C{(width, height)} of the full resolution image."""
+        key = self.key(filename)
+        with self._lock:
+            size = self._sizes.get(key)
+        if size is None:
+            size = image_header_size(filename)
+            if size is None:
+                surface = self.get(filename)
+                size = surface.get_width(), surface.get_height()
+            with self._lock:
+                self._sizes[key] = size
+        return size
+
+    def set_size(self, filename, size):
+        """Records the full resolution C{(width, height)} of C{filename},
+        e.g. from L{probe}, so C{size} needn't look at the file."""
+        key = self.key(filename)
+        with self._lock:
+            self._sizes[key] = size
+
+    def get_scaled(self, filename, scale):
+        """Returns the smallest pyramid level that covers C{scale}.
+
+        Painting the returned surface at C{scale} times the full resolution
+        size needs a final scale factor between 0.5 and 1 (or above 1 when
+        upscaling).
+
+        @type  scale: float
+        @param scale: Scale factor relative to the full resolution image.
+        @rtype:       tuple
+        @return:      C{(surface, level_scale_x, level_scale_y)}, where the
+                      level scales are the surface size relative to the full
+                      resolution size.
+        """
+        width, height = self.size(filename)
+        level = 0
+        while scale <= 0.5 ** (level + 1) and \
+              min(width, height) >> (level + 1) > 0:
+            level += 1
+        surface = self.get(filename, level)
+        return (surface, float(surface.get_width()) / width,
+                         float(surface.get_height()) / height)
+
+    def get_sized(self, filename, width, height):
+        """Returns a copy of the image resampled to C{width} x C{height}."""
+        return self.get(filename, (width, height))
+
+    def put(self, key, surface):
+        """Stores C{surface} under C{key} and evicts to stay within budget.
+
+        @type  key: tuple
+        @param key: C{(file key, level)}
+        """
+        file_key, level = key
+        with self._lock:
+            stale = self._keys.get(file_key[0])
+            if stale is not None and stale != file_key:
+                self._forget(stale)
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = surface
+            self._keys[file_key[0]] = file_key
+            if level == 0:
+                self._sizes[file_key] = surface.get_width(), surface.get_height()
+            self.bytes += surface_bytes(surface)
+            self.shrink()
+
+    def shrink(self, max_bytes=None):
+        """Evicts least recently used surfaces until the cache holds at most
+        C{max_bytes} (defaults to C{self.max_bytes}).
+        The most recently used surface is always kept."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        with self._lock:
+            while self.bytes > max_bytes and len(self._entries) > 1:
+                key = next(iter(self._entries))
+                self._drop(key)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops all cached surfaces."""
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._sizes.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Returns a dict of cache statistics."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def _decode(self, filename, key, level):
+        """Decodes C{filename} for pyramid level C{level} unless a level
+        below is cached already.
+
+        The loader may return any level between 0 and C{level}; it is
+        cached as that level.
+
+        @return: The surface of C{level}, or C{None} if it still has to be
+                 scaled down from a level below.
+        """
+        with self._lock:
+            for lower in range(level):
+                if (key, lower) in self._entries:
+                    return None
+        size = self.size(filename)
+        with profiling.phase(profiling.DECODE):
+            surface = self.loader(filename, level_size(size[0], size[1], level))
+        profiling.allocated(profiling.DECODE, surface_bytes(surface))
+        decoded = surface.get_width(), surface.get_height()
+        for lower in range(level, -1, -1):
+            if level_size(size[0], size[1], lower) == decoded:
+                if lower == level:
+                    return surface
+                self.put((key, lower), surface)
+                return None
+        # neither full size nor a level, e.g. the header was misread
+        return scale_surface(surface, *level_size(size[0], size[1], level))
+
+    def _drop(self, key):
+        surface = self._entries.pop(key)
+        self.bytes -= surface_bytes(surface)
+
+    def _forget(self, file_key):
+        """Drops all levels of an outdated file version."""
+        for key in [k for k in self._entries if k[0] == file_key]:
+            self._drop(key)
+        self._sizes.pop(file_key, None)
+
+
+def surface_bytes(surface):
+    """Returns the size of the pixel data held by an ImageSurface."""
+    return surface.get_stride() * surface.get_height()
+
+def scale_surface(surface, width, height):
+    """Returns a copy of C{surface} resampled to C{width} x C{height}."""
+    scaled = cairo.ImageSurface(surface.get_format(), width, height)
+    cr = cairo.Context(scaled)
+    cr.scale(float(width) / surface.get_width(),
+             float(height) / surface.get_height())
+    cr.set_source_surface(surface, 0, 0)
+    cr.get_source().set_filter(cairo.FILTER_GOOD)
+    cr.get_source().set_extend(cairo.EXTEND_PAD)    # don't fade out the edges
+    cr.set_operator(cairo.OPERATOR_SOURCE)
+    cr.paint()
+    return scaled
+
+# shared by all renderers, so each asset is decoded once per process
+image_cache = ImageCache()
+
+def cached_image_surface(filename):
+    """Returns the surface for C{filename} from the shared C{image_cache}."""
+    return image_cache.get(filename)
+
+def scaled_image_surface(filename, scale):
+    """Returns a pyramid level for C{filename} from the shared C{image_cache}.
+    See L{ImageCache.get_scaled}."""
+    return image_cache.get_scaled(filename, scale)
+
+def sized_image_surface(filename, width, height):
+    """Returns C{filename} resampled to C{width} x C{height} from the shared
+    C{image_cache}. See L{ImageCache.get_sized}."""
+    return image_cache.get_sized(filename, width, height)
+
+def image_size(filename):
+    """Returns the full resolution size of C{filename}."""
+    return image_cache.size(filename)
+
+def target_size(width, height, scale):
+    """Returns the size of a C{width} x C{height} image shown at C{scale},
+    in whole pixels and never above the full resolution."""
+    return (min(width, max(1, int(math.ceil(width * scale)))),
+            min(height, max(1, int(math.ceil(height * scale)))))
+
+def paint_image(cr, filename, sf, tx, ty, resolution=None):
+    """Paints the image C{filename} scaled by C{sf} and translated by
+    C{(tx, ty)} onto C{cr}.
+
+    @type  resolution: float
+    @param resolution: Device pixels per user space unit of C{cr} (e.g.
+                       C{dpi / 72.} for PDF). If given, the image is
+                       resampled to exactly the size it is shown at;
+                       equal sizes of a file get the same surface or at
+                       least the same C{MIME_TYPE_UNIQUE_ID}, which vector
+                       backends embed only once. Otherwise the
+                       closest pyramid level is painted.
+    """
+    iw, ih = image_size(filename)
+    if resolution is None:
+        image_surface, lx, ly = scaled_image_surface(filename, sf)
+    else:
+        width, height = target_size(iw, ih, sf * resolution)
+        image_surface = sized_image_surface(filename, width, height)
+        lx, ly = float(width) / iw, float(height) / ih
+
+    cr.save()
+    cr.translate(tx, ty)
+    cr.scale(sf / lx, sf / ly)
+    cr.set_source_surface(image_surface, 0, 0)
+    cr.paint()
+    cr.restore()
@@ -0,0 +1,116 @@
+"""Cache of shaped Pango layouts."""
+
+import threading
+from collections import OrderedDict
+
+import pango
+import pangocairo
+
+DEFAULT_LAYOUT_ENTRIES = 512 # number of layouts kept by the shared cache
+
+_font_descriptions = {}
+
+def font_description(family, size):
+    """Returns a (shared) C{pango.FontDescription} for C{family} at C{size}."""
+    key = (family, size)
+    description = _font_descriptions.get(key)
+    if description is None:
+        description = pango.FontDescription("%s %d" % key)
+        _font_descriptions[key] = description
+    return description
+
+
+class LayoutCache(object):
+    """A cache of shaped Pango layouts.
+
+    Layouts are keyed by their text, whether it is markup, font family,
+    font size, width and paragraph settings. They are created on a
+    context of the default Cairo font map, and must be bound to the Cairo
+    context they are drawn on with C{bind}; as long as the Cairo contexts
+    share their transformation and font options, the layout isn't shaped
+    again.
+
+    Cached layouts are shared, so hold C{lock} while using one. The
+    least recently used layouts are evicted beyond C{max_entries}.
+    """
+
+    def __init__(self, max_entries=DEFAULT_LAYOUT_ENTRIES):
+        """Creates a layout cache.
+
+        @type  max_entries: int
+        @param max_entries: Number of layouts to keep.
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        self._context = pangocairo.cairo_font_map_get_default().create_context()
+        self._entries = OrderedDict()
+
+    def get(self, text, family, size, markup=False, width=-1,
+            alignment=pango.ALIGN_LEFT, spacing=0, indent=0):
+        """Returns a layout of C{text}, shaping it on a miss.
+
+        @type  markup: bool
+        @param markup: Whether C{text} is Pango markup.
+        @type  width:  int
+        @param width:  Wrap width in Pango units, -1 to not wrap.
+        """
+        key = (text, family, size, markup, width, alignment, spacing, indent)
+        with self.lock:
+            layout = self._entries.pop(key, None)
+            if layout is not None:
+                self._entries[key] = layout     # mark as most recently used
+                self.hits += 1
+                return layout
+            self.misses += 1
+
+            layout = pango.Layout(self._context)
+            layout.set_font_description(font_description(family, size))
+            if markup:
+                layout.set_markup(text)
+            else:
+                layout.set_text(text)
+            layout.set_width(width)
+            layout.set_alignment(alignment)
+            layout.set_spacing(spacing)
+            layout.set_indent(indent)
+            layout.get_pixel_extents()          # shape now, not on first use
+
+            self._entries[key] = layout
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return layout
+
+    def bind(self, cr, layout):
+        """Binds C{layout} to C{cr}, so extents and drawing match the target.
+        The caller must hold C{lock}.
+
+        @return: The C{pangocairo.CairoContext} to draw the layout with.
+        """
+        pc = pangocairo.CairoContext(cr)
+        pc.update_layout(layout)
+        return pc
+
+    def clear(self):
+        """Drops all cached layouts."""
+        with self.lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dict of cache statistics."""
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries),
+                    'max_entries': self.max_entries}
+
+
+# shared by all renderers
+layout_cache = LayoutCache()
+
+def preshape(presentation, cr_width, cr_height):
+    """Shapes the text of all slides of C{presentation} for a
+    C{cr_width} x C{cr_height} surface, so rendering finds the layouts
+    in the shared C{layout_cache}."""
+    for slide in presentation.slides:
+        presentation.renderer.layout(slide, cr_width, cr_height)
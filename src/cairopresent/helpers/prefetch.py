@@ -0,0 +1,133 @@
+"""Background rendering of slides that are likely to be shown next."""
+
+import threading
+import traceback
+
+
+class Prefetcher(object):
+    """Renders slides on a pool of worker threads.
+
+    Jobs are identified by a hashable key, usually C{(slide_index, width,
+    height)}. C{render(key)} is called on a worker thread and must return
+    the finished surface; C{publish(key, surface)} is called on the same
+    worker thread afterwards, so GUIs should hand the surface over to their
+    main loop from there (e.g. with C{gobject.idle_add}).
+    """
+
+    def __init__(self, render, publish, workers=1, depth=1):
+        """Creates a prefetcher and starts its worker threads.
+
+        @param render:   Callable rendering the slide for a key.
+        @param publish:  Callable receiving C{(key, surface)} when done.
+        @type  workers:  int
+        @param workers:  Number of worker threads.
+        @type  depth:    int
+        @param depth:    Number of slides to prefetch in each direction.
+        """
+        self.render = render
+        self.publish = publish
+        self.depth = depth
+        self.scheduled = 0
+        self.rendered = 0
+        self.failed = 0
+        self.hits = 0
+        self.misses = 0
+        self._pending = []      # keys, most urgent first
+        self._running = set()
+        self._waiting = set()
+        self._results = {}      # key -> surface, for callers of wait()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='prefetch-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def neighbours(self, index, count):
+        """Returns the slide indices around C{index} in prefetch order:
+        C{index+1, index-1, index+2, index-2, ...} up to C{self.depth}."""
+        indices = []
+        for distance in range(1, self.depth + 1):
+            for neighbour in (index + distance, index - distance):
+                if 0 <= neighbour < count:
+                    indices.append(neighbour)
+        return indices
+
+    def schedule(self, keys):
+        """Replaces the pending jobs by C{keys}, most urgent first.
+        Jobs that are already being rendered are not scheduled again."""
+        with self._cond:
+            pending = [key for key in keys if key not in self._running]
+            self.scheduled += len(set(pending) - set(self._pending))
+            self._pending = pending
+            self._cond.notify_all()
+
+    def wait(self, key):
+        """Returns the surface for C{key} if a worker is rendering it,
+        waiting for it to finish; returns C{None} if it is not in flight.
+        A pending job for C{key} is cancelled, as the caller is about to
+        render it anyway."""
+        with self._cond:
+            if key in self._pending:
+                self._pending.remove(key)
+            if key not in self._running:
+                return None
+            self._waiting.add(key)
+            while key in self._running:
+                self._cond.wait()
+            self._waiting.discard(key)
+            return self._results.pop(key, None)
+
+    def count(self, hit):
+        """Records whether a slide was found prefetched when it was shown."""
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def stats(self):
+        """Returns a dict of prefetch statistics."""
+        shown = self.hits + self.misses
+        return {'depth': self.depth, 'workers': len(self._threads),
+                'scheduled': self.scheduled, 'rendered': self.rendered,
+                'failed': self.failed, 'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': shown and float(self.hits) / shown or 0.0}
+
+    def stop(self):
+        """Drops pending jobs and lets the worker threads exit."""
+        with self._cond:
+            self._stopped = True
+            self._pending = []
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                key = self._pending.pop(0)
+                self._running.add(key)
+
+            surface = None
+            try:
+                surface = self.render(key)
+            except Exception:
+                traceback.print_exc()
+
+            with self._cond:
+                self._running.discard(key)
+                if surface is None:
+                    self.failed += 1
+                else:
+                    self.rendered += 1
+                if key in self._waiting:
+                    self._results[key] = surface
+                self._cond.notify_all()
+
+            if surface is not None:
+                self.publish(key, surface)
@@ -0,0 +1,113 @@
+"""Per-phase timing of slide rendering.
+
+Rendering code marks its phases with C{phase}; the time spent in a phase and
+the bytes of pixel data it allocated are added to the profile that is active
+on the current thread, if any::
+
+    with profiling.profile() as p:
+        renderer.render_slide(cr, width, height, slide)
+    print p.times['decode'], p.bytes['decode']
+
+Phases may nest; time spent in an inner phase is not counted for the outer
+one. Without an active profile, C{phase} costs next to nothing.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+# phases recorded by the renderers and imageloader, in table order
+DECODE = 'decode'
+SCALE = 'scale'
+LAYOUT = 'layout'
+COMPOSITE = 'composite'
+PHASES = (DECODE, SCALE, LAYOUT, COMPOSITE)
+
+_local = threading.local()
+
+
+class RenderProfile(object):
+    """Timings and allocations of rendering one slide."""
+
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.)     # phase -> seconds
+        self.bytes = dict.fromkeys(PHASES, 0)      # phase -> bytes allocated
+        self.wall = 0.      # seconds from start to end of the profile
+
+    def add(self, name, seconds=0., nbytes=0):
+        """Adds C{seconds} and C{nbytes} to phase C{name}."""
+        self.times[name] = self.times.get(name, 0.) + seconds
+        self.bytes[name] = self.bytes.get(name, 0) + nbytes
+
+    def total_bytes(self):
+        return sum(self.bytes.values())
+
+    def as_dict(self):
+        """Returns the profile as a dict, with times in ms."""
+        return {'wall_ms': 1000 * self.wall,
+                'ms': dict((name, 1000 * t) for name, t in self.times.items()),
+                'bytes': dict(self.bytes)}
+
+
+@contextmanager
+def profile():
+    """Records the phases of the enclosed code on this thread into a new
+    C{RenderProfile}. Profiles don't nest; an enclosing one is suspended."""
+    outer = getattr(_local, 'profile', None), getattr(_local, 'stack', None)
+    result = _local.profile = RenderProfile()
+    _local.stack = []
+    start = time.time()
+    try:
+        yield result
+    finally:
+        result.wall = time.time() - start
+        _local.profile, _local.stack = outer
+
+@contextmanager
+def phase(name):
+    """Counts the time spent in the enclosed code for phase C{name}."""
+    current = getattr(_local, 'profile', None)
+    if current is None:
+        yield
+        return
+    stack = _local.stack
+    stack.append(0.)    # time spent in nested phases
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        current.add(name, elapsed - stack.pop())
+        if stack:
+            stack[-1] += elapsed
+
+def allocated(name, nbytes):
+    """Adds C{nbytes} of pixel data allocated to phase C{name} of the
+    active profile."""
+    current = getattr(_local, 'profile', None)
+    if current is not None:
+        current.add(name, 0., nbytes)
+
+def format_table(profiles):
+    """Returns a text table with a row per slide and a total row.
+
+    @type  profiles: dict
+    @param profiles: C{RenderProfile}s by slide index.
+    """
+    header = '%5s %9s' % ('slide', 'total ms') + \
+             ''.join(' %12s' % (name + ' ms') for name in PHASES) + ' %9s' % 'KB'
+    rows = [header]
+    total = RenderProfile()
+    for index in sorted(profiles):
+        p = profiles[index]
+        rows.append(_format_row(str(index), p))
+        total.wall += p.wall
+        for name in p.times:
+            total.add(name, p.times[name], p.bytes.get(name, 0))
+    rows.append(_format_row('all', total))
+    return '\n'.join(rows)
+
+def _format_row(label, p):
+    return '%5s %9.1f' % (label, 1000 * p.wall) + \
+           ''.join(' %12.1f' % (1000 * p.times.get(name, 0.)) for name in PHASES) + \
+           ' %9d' % (p.total_bytes() // 1024)
@@ -0,0 +1,98 @@
+"""Memory-bounded cache of rendered slide surfaces."""
+
+from cairopresent.helpers.imageloader import surface_bytes
+
+DEFAULT_SLIDE_CACHE_BYTES = 128 * 1024 * 1024 # ~16 slides at 1920x1080
+
+
+class SlideCache(object):
+    """A cache of rendered slides, keyed by slide index and geometry.
+
+    The cache holds at most C{max_bytes} of pixel data. When it has to
+    evict, it first drops slides rendered for another geometry than the
+    current one, then the slides farthest away from the current slide.
+
+    Entries of an old geometry are kept until they are replaced or evicted,
+    so e.g. toggling fullscreen doesn't throw away every rendered slide.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_SLIDE_CACHE_BYTES):
+        """Creates a slide cache.
+
+        @type  max_bytes: int
+        @param max_bytes: Memory budget for rendered slides.
+        """
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+        self.current_index = 0
+        self.current_geometry = None
+        self._entries = {}      # (index, geometry) -> surface
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, index, geometry):
+        """Returns the surface of slide C{index} at C{geometry}, or C{None}."""
+        surface = self._entries.get((index, geometry))
+        if surface is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return surface
+
+    def put(self, index, geometry, surface):
+        """Stores the surface of slide C{index} rendered at C{geometry}.
+        Replaces the slide's entries of other geometries."""
+        for key in [key for key in self._entries if key[0] == index]:
+            self._drop(key)
+        self._entries[(index, geometry)] = surface
+        self.bytes += surface_bytes(surface)
+        self.shrink()
+
+    def focus(self, index, geometry):
+        """Sets the current slide and geometry, which decide on eviction."""
+        self.current_index = index
+        self.current_geometry = geometry
+
+    def lookup(self, index):
+        """Returns C{(geometry, surface)} of slide C{index} at any geometry,
+        or C{(None, None)}."""
+        for key, surface in self._entries.items():
+            if key[0] == index:
+                return key[1], surface
+        return None, None
+
+    def shrink(self, max_bytes=None):
+        """Evicts slides until the cache holds at most C{max_bytes}
+        (defaults to C{self.max_bytes}). The current slide is always kept."""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        current = (self.current_index, self.current_geometry)
+        while self.bytes > max_bytes:
+            candidates = [key for key in self._entries if key != current]
+            if not candidates:
+                break
+            self._drop(max(candidates, key=self._eviction_rank))
+            self.evictions += 1
+
+    def stats(self):
+        """Returns a dict of cache statistics."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._entries),
+                'geometries': len(set(key[1] for key in self._entries)),
+                'bytes': self.bytes, 'max_bytes': self.max_bytes}
+
+    def _eviction_rank(self, key):
+        index, geometry = key
+        return (geometry != self.current_geometry,
+                abs(index - self.current_index))
+
+    def _drop(self, key):
+        surface = self._entries.pop(key)
+        self.bytes -= surface_bytes(surface)
@@ -0,0 +1,114 @@
+"""Lazily loaded slide sequences for large decks.
+
+A slide source can be used wherever a list of slides is expected: it has a
+length, can be indexed and iterated. Slides are only created when they are
+accessed, and at most C{max_slides} of them are kept in memory.
+"""
+
+import threading
+from collections import OrderedDict
+
+DEFAULT_MAX_SLIDES = 256
+
+
+class SlideSource(object):
+    """A sequence of slides that are created on first access.
+
+    Subclasses implement C{__len__} and C{load}.
+    """
+
+    def __init__(self, max_slides=DEFAULT_MAX_SLIDES):
+        """Creates a slide source.
+
+        @type  max_slides: int
+        @param max_slides: Number of created slides to keep in memory.
+        """
+        self.max_slides = max_slides
+        self.loads = 0
+        self._slides = OrderedDict()    # index -> slide, least recently used first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def load(self, index):
+        """Creates the slide at C{index}, which is within range."""
+        raise NotImplementedError
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('slide index out of range')
+        with self._lock:
+            slide = self._slides.pop(index, None)
+            if slide is not None:
+                self._slides[index] = slide    # mark as most recently used
+                return slide
+        slide = self.load(index)
+        with self._lock:
+            self.loads += 1
+            self._slides[index] = slide
+            while len(self._slides) > self.max_slides:
+                self._slides.popitem(last=False)
+        return slide
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_slides'] = OrderedDict()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+class FileSlideSource(SlideSource):
+    """Slides stored as byte ranges of a text file.
+
+    The file is scanned once when the source is created; C{scan} returns an
+    index entry per slide whose first two items are the byte offsets of the
+    slide's start and end. C{load} reads just that range again.
+    """
+
+    def __init__(self, filename, max_slides=DEFAULT_MAX_SLIDES):
+        """Creates a slide source and indexes C{filename}."""
+        SlideSource.__init__(self, max_slides)
+        self.filename = filename
+        f = open(filename, 'rb')
+        try:
+            self.index = self.scan(f)
+        finally:
+            f.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def scan(self, f):
+        """Returns the list of index entries of the slides in C{f}."""
+        raise NotImplementedError
+
+    def read(self, index):
+        """Returns the source text of slide C{index}."""
+        entry = self.index[index]
+        f = open(self.filename, 'rb')
+        try:
+            f.seek(entry[0])
+            return f.read(entry[1] - entry[0])
+        finally:
+            f.close()
+
+
+def lines_with_offsets(f):
+    """Yields C{(offset, line)} for each line of the file C{f}."""
+    offset = f.tell()
+    for line in iter(f.readline, ''):
+        yield offset, line
+        offset += len(line)
@@ -0,0 +1,15 @@
+"""The fade through black between slides, shared by the GUI and the video
+export so both look the same."""
+
+TRANSITION_DURATION = 600   # ms for fade-out plus fade-in
+
+
+def fade_alpha(progress):
+    """Returns the opacity of the shown slide at C{progress} (0 to 1) of a
+    fade: 1 at both ends and 0 in the middle."""
+    return abs(2 * progress - 1)
+
+def fade_to_next(progress):
+    """Returns whether the slide faded in, rather than the one faded out,
+    is shown at C{progress} (0 to 1) of a fade."""
+    return progress >= .5
@@ -1,11 +1,141 @@
 """Lawrance Lessig style Presentation and Renderer."""
 
 import os
+from cStringIO import StringIO
 
 import pango
-import pangocairo
 
-from cairopresent.helpers import imageloader
+from cairopresent.helpers import imageloader, profiling, slidesource
+from cairopresent.helpers.layoutcache import layout_cache
+
+
+# line types returned by classify()
+TEXT_LINE = 'text'
+BREAK = 'break'                 # empty line
+NO_TRANSITION_BREAK = 'nobreak' # line consisting of '+'
+
+EMPH_OPEN = '<span color="#BB0000">'
+EMPH_CLOSE = '</span>'
+
+def classify(line):
+    """Returns the token type of a line of a presentation file, or C{None}
+    for comment lines."""
+    if line.startswith('#'):
+        return None
+    elif line in ('\r\n', '\n'):
+        return BREAK
+    elif line in ('+\r\n', '+\n'):
+        return NO_TRANSITION_BREAK
+    return TEXT_LINE
+
+def markup(line, open_emph=False):
+    """Converts a line of text to Pango markup.
+    Text between asterisks is emphasized, emphasis may span lines.
+    
+    @return: C{(markup, open_emph)}, where C{open_emph} tells whether
+             emphasis is still open at the end of the line.
+    """
+    line = line.replace('<', '&lt;')
+    line = line.replace('>', '&gt;')
+    parts = line.split('*')
+    result = [parts[0]]
+    for part in parts[1:]:
+        result.append(open_emph and EMPH_CLOSE or EMPH_OPEN)
+        result.append(part)
+        open_emph = not open_emph
+    return ''.join(result), open_emph
+
+
+class Slide(object):
+    """A single slide of a Lessig style presentation."""
+    
+    TEXT = 'text'
+    IMAGE = 'img'
+    
+    __slots__ = ('kind', 'markup', 'image', 'first_line', 'last_line')
+    
+    def __init__(self, kind, markup, image, first_line, last_line):
+        """Creates a slide.
+        
+        @type  kind:       string
+        @param kind:       C{Slide.TEXT} or C{Slide.IMAGE}.
+        @type  markup:     string
+        @param markup:     Pango markup of a text slide.
+        @type  image:      string
+        @param image:      Image path of an image slide, as given in the file.
+        @type  first_line: int
+        @param first_line: Line number in the source file where the slide starts.
+        @type  last_line:  int
+        @param last_line:  Line number in the source file where the slide ends.
+        """
+        self.kind = kind
+        self.markup = markup
+        self.image = image
+        self.first_line = first_line
+        self.last_line = last_line
+        
+    def __repr__(self):
+        return 'Slide(%r, %r, %r, %d, %d)' % (self.kind, self.markup, self.image,
+                                              self.first_line, self.last_line)
+
+
+class SlideFile(slidesource.FileSlideSource):
+    """The slides of a Lessig style presentation file.
+    
+    The file is scanned once for slide boundaries; a slide is parsed when it
+    is first accessed.
+    """
+    
+    def scan(self, f):
+        """Indexes the slides of C{f}. Collects the slide pairs separated by a
+        C{+} line in C{self.no_transition}.
+        
+        @return: A list of C{(start, end, first_line, last_line, open_emph)}
+                 entries, where C{open_emph} tells whether emphasis is open
+                 at the start of the slide.
+        """
+        self.no_transition = set()
+        index = []
+        start = end = first_line = last_line = None
+        open_emph = start_emph = False
+        
+        for line_number, (offset, line) in enumerate(slidesource.lines_with_offsets(f), 1):
+            token = classify(line)
+            if token == TEXT_LINE:
+                if start is None:
+                    start, first_line, start_emph = offset, line_number, open_emph
+                end, last_line = offset + len(line), line_number
+                open_emph ^= line.count('*') % 2 == 1    # see markup()
+            elif token is not None and start is not None:
+                index.append((start, end, first_line, last_line, start_emph))
+                if token == NO_TRANSITION_BREAK:
+                    self.no_transition.add((len(index) - 1, len(index)))
+                start = None
+            else:
+                pass    # comment, or ^\n$ or ^+\n$ at beginning of presentation
+        
+        if start is not None:
+            index.append((start, end, first_line, last_line, start_emph))
+        
+        return index
+    
+    def load(self, index):
+        start, end, first_line, last_line, open_emph = self.index[index]
+        lines = []
+        markups = []
+        for line in StringIO(self.read(index)):
+            if classify(line) == TEXT_LINE:    # skips comments within the slide
+                lines.append(line)
+                line_markup, open_emph = markup(line, open_emph)
+                markups.append(line_markup)
+        return self.make_slide(lines, markups, first_line, last_line)
+        
+    def make_slide(self, lines, markups, first_line, last_line):
+        """Creates a C{Slide} from its source lines and their markup."""
+        if lines[0].startswith('img::'):
+            image = ''.join(lines).split('img::')[-1].strip()
+            return Slide(Slide.IMAGE, None, image, first_line, last_line)
+        return Slide(Slide.TEXT, ''.join(markups), None, first_line, last_line)
 
 
 class Presentation(object):
@@ -14,62 +144,24 @@ class Presentation(object):
     Slides will have black background, and centered white (or alternatively red) text. 
     """
      
-    def __init__(self, filename):
+    def __init__(self, filename, max_slides=slidesource.DEFAULT_MAX_SLIDES):
         """Creates a PZ style presentation object.
         
-        @type  filename: string
-        @param filename: Path to the presentation.
+        Opening a presentation only indexes the file; slides are parsed on
+        first access, and at most C{max_slides} are kept in memory.
+        
+        @type  filename:   string
+        @param filename:   Path to the presentation.
+        @type  max_slides: int
+        @param max_slides: Number of parsed slides to keep in memory.
         """
         
-        self.no_transition = []
-        self.slides = self.parse_file(filename)
+        self.slides = SlideFile(filename, max_slides)
+        self.no_transition = self.slides.no_transition
         self.renderer = Renderer(os.path.dirname(filename))
         
-    def parse_file(self, filename):
-        slides = []
-        current_slide = ''
-        slide_index = 0
-        
-        f = open(filename)
-        open_emph = False
-        for line in f:
-            if line.startswith('#'):
-                continue
-            elif line in ('\r\n', '\n'):
-                if current_slide:
-                    slides.append(current_slide)
-                    slide_index += 1
-                    current_slide = ''
-                else:
-                    pass    # ^\n$ at beginning of presentation
-            elif line in ('+\r\n', '+\n'):
-                if current_slide:
-                    slides.append(current_slide)
-                    self.no_transition.append((slide_index, slide_index+1))
-                    slide_index += 1
-                    current_slide = ''
-                else:
-                    pass    # ^+\n$ at beginning of presentation
-            else:
-                line = line.replace('<', '&lt;')
-                line = line.replace('>', '&gt;')
-                while '*' in line:
-                    if not open_emph:
-                        line = line.replace('*', '<span color="#BB0000">', 1)
-                    else:
-                        line = line.replace('*', '</span>', 1)
-                    open_emph = not open_emph
-                current_slide += line
-        
-        if current_slide:
-            slides.append(current_slide)
-                        
-        return slides
-
     def show_transition(self, from_slide, to_slide):
-        if (from_slide, to_slide) in self.no_transition:
-            return False
-        return True
+        return (from_slide, to_slide) not in self.no_transition
         
 class Renderer(object):
     """A renderer for Lessig style rendering.
@@ -80,55 +172,90 @@ class Renderer(object):
     def __init__(self, base_dir):
         self.base_dir = base_dir
 
-    def render_slide(self, cr, cr_width, cr_height, slide):
-        """Renders the slide C{current_slide} onto the given Cairo context C{cr}."""
+    def image_path(self, slide):
+        """Returns the path of the image shown on an image slide."""
+        if os.path.isabs(slide.image):
+            return slide.image
+        return os.path.join(self.base_dir, slide.image)
+
+    def slide_key(self, slide):
+        """Returns a string identifying the content of C{slide}."""
+        return repr((slide.kind, slide.markup, slide.image))
+
+    def slide_assets(self, slide):
+        """Returns the paths of the images shown on C{slide}."""
+        if slide.kind == Slide.IMAGE:
+            return [self.image_path(slide)]
+        return []
+
+    def slide_source(self, slide):
+        """Returns the text of C{slide} as written in the presentation file,
+        without comments."""
+        if slide.kind == Slide.IMAGE:
+            return 'img::' + slide.image
+        text = slide.markup.replace(EMPH_OPEN, '*').replace(EMPH_CLOSE, '*')
+        return text.replace('&lt;', '<').replace('&gt;', '>')
+
+    def layout(self, slide, cr_width, cr_height):
+        """Returns the (cached) Pango layout of a text slide, or C{None}."""
+        if slide.kind != Slide.TEXT:
+            return None
+        return layout_cache.get(slide.markup, "Yanone Tagesschrift",
+                                int(cr_height/20.), markup=True,
+                                alignment=pango.ALIGN_CENTER,
+                                spacing=int(1./25 * cr_height * pango.SCALE))
+
+    def image_geometry(self, iw, ih, cr_width, cr_height):
+        """Returns the scale factor and translation C{(sf, tx, ty)} that fit
+        an C{iw} x C{ih} image into the slide."""
+        # scale factor and translation to zoom to center of image
+        sf = min(float(cr_width) / iw, float(cr_height) / ih)    # scale factor
+        tx = (cr_width - sf * iw) / 2    # translate x
+        ty = (cr_height - sf * ih) / 2   # translate y
+        return sf, tx, ty
+
+    def render_slide(self, cr, cr_width, cr_height, slide, resolution=None):
+        """Renders the slide C{current_slide} onto the given Cairo context C{cr}.
+        
+        @type  resolution: float
+        @param resolution: Device pixels per unit of C{cr}, see
+                           L{imageloader.paint_image}.
+        """
         
-        cr.set_source_rgb(0.0, 0.0, 0.0)
-        cr.paint()
+        self.render_background(cr, cr_width, cr_height, slide, resolution)
+        self.render_text(cr, cr_width, cr_height, slide)
         
-        if slide.startswith('img::'):
-            img_filename = slide.split('img::')[-1].strip()
-            if not os.path.isabs(img_filename):
-                img_filename = os.path.join(self.base_dir, img_filename)
+    def render_background(self, cr, cr_width, cr_height, slide, resolution=None):
+        """Renders the background layer (black, and the image of an image
+        slide) of a slide."""
+        
+        with profiling.phase(profiling.COMPOSITE):
+            cr.set_source_rgb(0.0, 0.0, 0.0)
+            cr.paint()
             
-            # load image surface
-            image_surface = None
-            if img_filename == '.png':
-                try:
-                    # causes MemoryError if filename doesn't point to a PNG
-                    image_surface = imageloader.image_surface_with_cairo(img_filename)
-                except MemoryError:
-                    image_surface = imageloader.image_surface_with_pil(img_filename)
-            else:
-                image_surface = imageloader.image_surface_with_pil(img_filename)
+            if slide.kind == Slide.IMAGE:
+                img_filename = self.image_path(slide)
                 
-            # get geometry info
-            iw, ih = image_surface.get_width(), image_surface.get_height()
-            # scale factor and translation to zoom to center of image
-            sf = min(float(cr_width) / iw, float(cr_height) / ih)    # scale factor
-            tx = (cr_width - sf * iw) / 2    # translate x
-            ty = (cr_height - sf * ih) / 2   # translate y
-            
-            # paint image
-            cr.push_group()
-            cr.translate(tx, ty)
-            cr.scale(sf, sf)
-            cr.set_source_surface(image_surface, 0, 0)
-            cr.paint()
-            cr.pop_group_to_source()
-            cr.paint()
+                # get geometry info
+                iw, ih = imageloader.image_size(img_filename)
+                sf, tx, ty = self.image_geometry(iw, ih, cr_width, cr_height)
+                
+                # paint image; sf lets the loader decode a JPEG at reduced size
+                imageloader.paint_image(cr, img_filename, sf, tx, ty, resolution)
             
-        else:
+    def render_text(self, cr, cr_width, cr_height, slide):
+        """Renders the text layer of a slide."""
+        
+        if slide.kind == Slide.TEXT:
             # render some text (w/ pango)
-            pc = pangocairo.CairoContext(cr)
-            layout = pc.create_layout()
-            layout.set_font_description(pango.FontDescription("Yanone Tagesschrift %d" % int(cr_height/20.)))
-            layout.set_markup(slide)
-            layout.set_alignment(pango.ALIGN_CENTER)
-            layout.set_spacing(int(1./25 * cr_height * pango.SCALE))
-            ink_rect, logical_rect = layout.get_pixel_extents()
-            tx, ty, tw, th = logical_rect
-            cr.move_to((cr_width - tw)/2, (cr_height - th)/2)
-            cr.set_source_rgb(1.0, 1.0, 1.0)
-            pc.show_layout(layout)
+            with layout_cache.lock:
+                with profiling.phase(profiling.LAYOUT):
+                    layout = self.layout(slide, cr_width, cr_height)
+                    pc = layout_cache.bind(cr, layout)
+                    ink_rect, logical_rect = layout.get_pixel_extents()
+                with profiling.phase(profiling.COMPOSITE):
+                    tx, ty, tw, th = logical_rect
+                    cr.move_to((cr_width - tw)/2, (cr_height - th)/2)
+                    cr.set_source_rgb(1.0, 1.0, 1.0)
+                    pc.show_layout(layout)
         
@@ -1,9 +1,29 @@
 """thpani style Presentation and Renderer."""
 
+import json
+import os
+
 import pango
-import pangocairo
 
-from cairopresent.helpers import imageloader
+from cairopresent.helpers import imageloader, profiling, slidesource
+from cairopresent.helpers.layoutcache import layout_cache
+
+
+class SlideFile(slidesource.FileSlideSource):
+    """The slides of a JSON lines deck: one C{[bg_image_path, text]} array
+    per line, with image paths relative to the file. Blank lines are
+    skipped.
+    """
+    
+    def scan(self, f):
+        """Returns a C{(start, end)} entry for each slide of C{f}."""
+        return [(offset, offset + len(line))
+                for offset, line in slidesource.lines_with_offsets(f)
+                if line.strip()]
+    
+    def load(self, index):
+        bg, text = json.loads(self.read(index))
+        return os.path.join(os.path.dirname(self.filename), bg), text
 
 
 class Presentation(object):
@@ -15,8 +35,9 @@ class Presentation(object):
     def __init__(self, slides):
         """Creates a thpani style presentation object.
         
-        @type  slides: list of tuples
-        @param slides: A list of tuples given as C{(bg_image_path, text)}.
+        @type  slides: sequence of tuples
+        @param slides: A list of tuples given as C{(bg_image_path, text)},
+                       or a lazily loaded sequence like a C{SlideFile}.
         """
         self.slides = slides
         self.renderer = Renderer
@@ -33,51 +54,80 @@ class Renderer(object):
     """
     
     @classmethod
-    def render_slide(cls, cr, cr_width, cr_height, slide):
-        """Renders the slide C{current_slide} onto the given Cairo context C{cr}."""
-        
-        # load image surface
-        image_surface = None
-        if slide[0][-4:].lower() == '.png':
-            try:
-                # causes MemoryError if filename doesn't point to a PNG
-                image_surface = imageloader.image_surface_with_cairo(slide[0])
-            except MemoryError:
-                image_surface = imageloader.image_surface_with_pil(slide[0])
-        else:
-            image_surface = imageloader.image_surface_with_pil(slide[0])
-            
-        # get geometry info
-        iw, ih = image_surface.get_width(), image_surface.get_height()
+    def slide_key(cls, slide):
+        """Returns a string identifying the content of C{slide}."""
+        return repr(tuple(slide))
+    
+    @classmethod
+    def slide_assets(cls, slide):
+        """Returns the paths of the images shown on C{slide}."""
+        return [slide[0]]
+    
+    @classmethod
+    def slide_source(cls, slide):
+        """Returns the text and background image of C{slide}."""
+        return '%s\n\n[%s]' % (slide[1], os.path.basename(slide[0]))
+    
+    @classmethod
+    def layout(cls, slide, cr_width, cr_height):
+        """Returns the (cached) Pango layout of a slide's text."""
+        return layout_cache.get(slide[1], "Yanone Kaffeesatz Bold",
+                                int(cr_height/12.),
+                                indent=int(.03 * cr_width * pango.SCALE),
+                                spacing=int(1./60 * cr_height * pango.SCALE))
+    
+    @classmethod
+    def image_geometry(cls, iw, ih, cr_width, cr_height):
+        """Returns the scale factor and translation C{(sf, tx, ty)} that make
+        an C{iw} x C{ih} image cover the slide."""
         # scale factor and translation to zoom to center of image
         sf = max(float(cr_width) / iw, float(cr_height) / ih)    # scale factor
         tx = (cr_width - sf * iw) / 2    # translate x
         ty = (cr_height - sf * ih) / 2   # translate y
+        return sf, tx, ty
+    
+    @classmethod
+    def render_slide(cls, cr, cr_width, cr_height, slide, resolution=None):
+        """Renders the slide C{current_slide} onto the given Cairo context C{cr}.
+        
+        @type  resolution: float
+        @param resolution: Device pixels per unit of C{cr}, see
+                           L{imageloader.paint_image}.
+        """
+        
+        cls.render_background(cr, cr_width, cr_height, slide, resolution)
+        cls.render_text(cr, cr_width, cr_height, slide)
         
-        # paint image
-        cr.push_group()
-        cr.translate(tx, ty)
-        cr.scale(sf, sf)
-        cr.set_source_surface(image_surface, 0, 0)
-        cr.paint()
-        cr.pop_group_to_source()
-        cr.paint()
+    @classmethod
+    def render_background(cls, cr, cr_width, cr_height, slide, resolution=None):
+        """Renders the background layer (the image) of a slide."""
+        
+        # get geometry info
+        iw, ih = imageloader.image_size(slide[0])
+        sf, tx, ty = cls.image_geometry(iw, ih, cr_width, cr_height)
+        
+        # paint image; sf lets the loader decode a JPEG at reduced size
+        with profiling.phase(profiling.COMPOSITE):
+            imageloader.paint_image(cr, slide[0], sf, tx, ty, resolution)
+        
+    @classmethod
+    def render_text(cls, cr, cr_width, cr_height, slide):
+        """Renders the text layer (text and its box) of a slide."""
         
         # render some text (w/ pango)
-        pc = pangocairo.CairoContext(cr)
-        layout = pc.create_layout()
-        layout.set_font_description(pango.FontDescription("Yanone Kaffeesatz Bold %d" % int(cr_height/12.)))
-        layout.set_text(slide[1])
-        layout.set_indent(int(.03 * cr_width * pango.SCALE))
-        layout.set_spacing(int(1./60 * cr_height * pango.SCALE))
-        ink_rect, logical_rect = layout.get_pixel_extents()
-        cr.rectangle(0, int(.06 * cr_height),
-                     int(logical_rect[2] + .06 * cr_width),
-                     int(logical_rect[3] + .05 * cr_height)
-                     )
-        cr.set_source_rgba(.90, .90, .90, .5)
-        cr.fill()
-        cr.move_to(0, int(.085 * cr_height)) # rect y_offset + rect_margin/2
-        cr.set_source_rgb(0.0, 0.0, 0.0)
-        pc.show_layout(layout)
+        with layout_cache.lock:
+            with profiling.phase(profiling.LAYOUT):
+                layout = cls.layout(slide, cr_width, cr_height)
+                pc = layout_cache.bind(cr, layout)
+                ink_rect, logical_rect = layout.get_pixel_extents()
+            with profiling.phase(profiling.COMPOSITE):
+                cr.rectangle(0, int(.06 * cr_height),
+                             int(logical_rect[2] + .06 * cr_width),
+                             int(logical_rect[3] + .05 * cr_height)
+                             )
+                cr.set_source_rgba(.90, .90, .90, .5)
+                cr.fill()
+                cr.move_to(0, int(.085 * cr_height)) # rect y_offset + rect_margin/2
+                cr.set_source_rgb(0.0, 0.0, 0.0)
+                pc.show_layout(layout)
         
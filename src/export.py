@@ -2,21 +2,66 @@
 
 """Provides PDF, PNG, SVG and PIL export routines."""
 
+import array
+import collections
+import hashlib
+import itertools
+import json
 import os
+import sys
+import traceback
 
 import cairo
 
 import cairopresent
+from cairopresent.helpers import assets, diskcache, imageloader, profiling
 from cairopresent.helpers.resources import get_example
+from cairopresent.helpers.transition import TRANSITION_DURATION, fade_alpha, fade_to_next
+
+
+MANIFEST_VERSION = 1
+
+# index of R, G and B in the native-endian pixels of a cairo RGB24 surface
+if sys.byteorder == 'little':
+    _RGB = [2, 1, 0]
+else:
+    _RGB = [1, 2, 3]
+
+# RGB (0..1) to limited range BT.601 Y'CbCr, without the (16, 128, 128) offset
+_YCBCR = [[ 65.481, 128.553,  24.966],
+          [-37.797, -74.203, 112.0  ],
+          [112.0,   -93.786, -18.214]]
+
+# set in worker processes of a parallel export
+_worker_export = None
+
+def _init_worker(export):
+    global _worker_export
+    _worker_export = export
+
+def _export_slide_worker(index):
+    """Exports a single slide in a worker process.
+    Returns C{(index, result, error, profile)}; C{error} is a formatted
+    traceback."""
+    with profiling.profile() as profile:
+        try:
+            slide = _worker_export.slides[index]
+            return index, _worker_export.export_slide(index, slide), None, profile
+        except Exception:
+            return index, None, traceback.format_exc(), profile
 
 
 class Export(object):
     """Exports slides to graphics files.
     
-    @attention: Abstract! Implementations must override C{render(self)}.
+    @attention: Abstract! Implementations must override
+    C{export_slide(self, index, slide)} or C{render(self)}.
     """
     
-    def __init__(self, presentation, filename, geometry):
+    extension = None    # of the per-slide output files
+    
+    def __init__(self, presentation, filename, geometry, processes=1,
+                 incremental=False):
         """Creates a graphics export object.
         
         @param presentation: The presentation to export.
@@ -24,67 +69,471 @@ class Export(object):
         @param filename:  Basename (w/o extension). To get I{foo-{0,1,2,3,...}.ext}, supply C{filename="foo"}. Implementation will decide on I{ext}.
         @type  geometry:  tuple
         @param geometry:  (width, height)
+        @type  processes: int
+        @param processes: Number of worker processes. C{1} exports in this
+                          process, C{None} uses one process per CPU.
+        @type  incremental: bool
+        @param incremental: Only re-render slides that changed since the
+                            last export, see L{render}.
         """
+        self.presentation = presentation
         self.slides = presentation.slides
         self.renderer = presentation.renderer
         self.filename = filename
         self.width, self.height = geometry
+        self.processes = processes
+        self.incremental = incremental
+        self.errors = []
+        self.skipped = 0
+        self.profiles = {}  # slide index -> profiling.RenderProfile
+        self.asset_report = None    # assets.AssetReport, see check_assets
         
     def render(self):
-        """Starts rendering the slides."""
+        """Starts rendering the slides.
+        
+        In parallel mode a failing slide doesn't stop the export; its
+        traceback is printed and recorded in C{self.errors}.
+        
+        In incremental mode a manifest (C{<filename>.manifest.json}) records
+        what each output file was rendered from; slides whose key (see
+        L{slide_key}) didn't change are skipped, and output files of slides
+        that no longer exist are deleted.
+        
+        Per-phase timings of each rendered slide are kept in
+        C{self.profiles} and printed as a table when the export is done.
+        
+        @rtype:  list
+        @return: C{(index, traceback)} for each slide that failed.
+        """
+        self.check_assets()
+        if not self.incremental:
+            self.export_slides()
+            self.report_profiles()
+            return self.errors
+        
+        old = self.read_manifest()
+        keys = [self.slide_key(index) for index in range(len(self.slides))]
+        indices = [index for index, key in enumerate(keys)
+                   if old.get(str(index)) != key or
+                   not os.path.exists(self.slide_filename(index, self.extension))]
+        self.skipped = len(keys) - len(indices)
+        self.export_slides(indices)
+        
+        failed = set(index for index, error in self.errors)
+        self.write_manifest(dict((str(index), key) for index, key in enumerate(keys)
+                                 if index not in failed))
+        for index in old:
+            index = int(index)
+            filename = self.slide_filename(index, self.extension)
+            if index >= len(self.slides) and os.path.exists(filename):
+                os.remove(filename)
+        self.report_profiles()
+        return self.errors
+        
+    def check_assets(self):
+        """Probes the images of the presentation (see L{assets.probe_assets})
+        and prints the broken ones before any slide is rendered. Worker
+        processes started afterwards inherit the image sizes found.
+        
+        Does nothing if C{self.asset_report} was set by the caller, e.g. a
+        service that probed the deck when loading it.
+        
+        @rtype:  L{assets.AssetReport}
+        """
+        if self.asset_report is None:
+            self.asset_report = assets.probe_assets(self.presentation)
+            if self.asset_report.errors:
+                print >> sys.stderr, "%s: %d broken image(s):\n%s" % (
+                        self.filename, len(self.asset_report.errors),
+                        self.asset_report.format_errors())
+        return self.asset_report
+        
+    def export_slide(self, index, slide):
+        """Exports a single slide. Called in a worker process in parallel mode."""
         raise NotImplementedError
+        
+    def export_slides(self, indices=None):
+        """Calls C{export_slide} for C{indices} (defaults to all slides),
+        spreading them over C{self.processes} worker processes.
+        
+        @rtype:  dict
+        @return: The results of C{export_slide} by index; failed slides are
+                 left out.
+        """
+        return dict((index, result) for index, result, error
+                    in self.iter_export_slides(indices) if error is None)
+        
+    def iter_export_slides(self, indices=None):
+        """Like C{export_slides}, but yields C{(index, result, error)} in
+        the order of C{indices} as soon as each slide and all slides before
+        it are done. At most two slides per worker are in flight or waiting
+        to be consumed, so large results like page rasters don't pile up.
+        
+        C{error} is the traceback of a failed slide, or C{None}.
+        """
+        if indices is None:
+            indices = range(len(self.slides))
+        self.errors = []
+        self.profiles = {}
+        
+        if self.processes == 1:
+            for index in indices:
+                with profiling.profile() as self.profiles[index]:
+                    result = self.export_slide(index, self.slides[index])
+                yield index, result, None
+            return
+        
+        import multiprocessing
+        
+        workers = self.processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers, _init_worker, (self,))
+        try:
+            indices = iter(indices)
+            in_flight = collections.deque(
+                    pool.apply_async(_export_slide_worker, (index,))
+                    for index in itertools.islice(indices, 2 * workers))
+            while in_flight:
+                index, result, error, profile = in_flight.popleft().get()
+                for next_index in itertools.islice(indices, 1):
+                    in_flight.append(pool.apply_async(_export_slide_worker, (next_index,)))
+                self.profiles[index] = profile
+                if error is not None:
+                    self.errors.append((index, error))
+                    print >> sys.stderr, "slide %d failed:\n%s" % (index, error)
+                yield index, result, error
+        finally:
+            pool.close()
+            pool.join()
+        
+    def report_profiles(self):
+        """Prints the per-phase timings in C{self.profiles} as a table."""
+        if self.profiles:
+            print >> sys.stderr, "%s: render times by phase" % self.filename
+            print >> sys.stderr, profiling.format_table(self.profiles)
+        
+    def slide_filename(self, index, extension):
+        """Returns the output filename of slide C{index}."""
+        return "%s-%d.%s" % (self.filename, index, extension)
+        
+    def slide_key(self, index):
+        """Returns what the output of slide C{index} depends on, see
+        L{diskcache.slide_key}."""
+        return diskcache.slide_key(self.renderer, self.slides[index],
+                                   (self.width, self.height))
+        
+    def manifest_filename(self):
+        return "%s.manifest.json" % self.filename
+        
+    def read_manifest(self):
+        """Returns the slide keys of the last incremental export by index,
+        or an empty dict."""
+        try:
+            f = open(self.manifest_filename())
+            try:
+                manifest = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION or \
+           manifest.get('extension') != self.extension:
+            return {}
+        return manifest['slides']
+        
+    def write_manifest(self, slides):
+        f = open(self.manifest_filename(), 'w')
+        json.dump({'version': MANIFEST_VERSION, 'extension': self.extension,
+                   'slides': slides}, f, indent=1, sort_keys=True)
+        f.close()
 
 
 class PDFExport(Export):
-    """Exports slides to a PNG file."""
+    """Exports slides to a PDF file."""
     
-    def __init__(self, presentation, filename="pdffile.pdf", geometry=(1024, 768)):
-        """Creates a PDF export object."""
-        Export.__init__(self, presentation, filename, geometry)
+    def __init__(self, presentation, filename="pdffile.pdf", geometry=(1024, 768),
+                 processes=1, rasterise=False, raster_scale=2.0, dpi=150):
+        """Creates a PDF export object.
+        
+        Images are embedded at the size they are shown at on the page,
+        resampled to C{dpi}, and each distinct image is embedded only once.
+        
+        @type  dpi:          int
+        @param dpi:          Resolution of embedded images, assuming the page
+                             geometry is given in points (1/72 inch).
+        @type  rasterise:    bool
+        @param rasterise:    Embed each page as a bitmap instead of vector
+                             graphics. Pages are then rendered in parallel
+                             if C{processes} isn't C{1}.
+        @type  raster_scale: float
+        @param raster_scale: Bitmap pixels per PDF point when rasterising.
+        """
+        Export.__init__(self, presentation, filename, geometry, processes)
+        self.rasterise = rasterise
+        self.raster_scale = raster_scale
+        self.dpi = dpi
+        self.images = []
     
     def render(self):
+        self.check_assets()
         surface = cairo.PDFSurface(self.filename, self.width, self.height)
         cr = cairo.Context(surface)
-        for slide in self.slides:
-            self.renderer.render_slide(cr, self.width, self.height, slide)
-            cr.show_page()
+        if not self.rasterise:
+            self.errors = []
+            self.profiles = {}
+            # equal images come from the image cache with the same unique id
+            # (see ImageCache.get), which cairo embeds once and references
+            # from every page, even if the cache evicted the surface meanwhile
+            for index, slide in enumerate(self.slides):
+                with profiling.profile() as self.profiles[index]:
+                    self.renderer.render_slide(cr, self.width, self.height, slide,
+                                               resolution=self.dpi / 72.)
+                    cr.show_page()
+            surface.finish()
+            self.report_images()
+            self.report_profiles()
+            return self.errors
+        
+        # pages arrive in order, each is written as soon as it is rendered
+        for index, page, error in self.iter_export_slides():
+            if error is None:
+                width, height, stride, data = page
+                page = cairo.ImageSurface.create_for_data(
+                        array.array('c', data), cairo.FORMAT_ARGB32,
+                        width, height, stride)
+                cr.save()
+                cr.scale(float(self.width) / width, float(self.height) / height)
+                cr.set_source_surface(page, 0, 0)
+                cr.paint()
+                cr.restore()
+            cr.show_page()    # failed slides leave a blank page
+        surface.finish()
+        self.report_profiles()
+        return self.errors
+    
+    def report_images(self):
+        """Collects the embedded images in C{self.images} and prints an
+        estimate of the pixel data spent on each: 3 bytes per pixel before
+        compression, the actual size in the file depends on the encoding
+        cairo picks."""
+        images = {}
+        for index, slide in enumerate(self.slides):
+            for path in self.renderer.slide_assets(slide):
+                iw, ih = imageloader.image_size(path)
+                sf = self.renderer.image_geometry(iw, ih, self.width, self.height)[0]
+                width, height = imageloader.target_size(iw, ih, sf * self.dpi / 72.)
+                image = images.setdefault((path, width, height),
+                        {'path': path, 'width': width, 'height': height,
+                         'bytes': width * height * 3, 'pages': []})
+                image['pages'].append(index)
+        self.images = sorted(images.values(), key=lambda image: -image['bytes'])
+        
+        for image in self.images:
+            print >> sys.stderr, "%s: %dx%d, est. %d KB uncompressed, %d page(s)" % (
+                    os.path.basename(image['path']), image['width'],
+                    image['height'], image['bytes'] // 1024, len(image['pages']))
+        print >> sys.stderr, "%s: %d images, est. %d KB of uncompressed pixel data, %d KB written" % (
+                self.filename, len(self.images),
+                sum(image['bytes'] for image in self.images) // 1024,
+                os.path.getsize(self.filename) // 1024)
+    
+    def export_slide(self, index, slide):
+        """Rasterises a page; returns C{(width, height, stride, data)}."""
+        width = int(round(self.width * self.raster_scale))
+        height = int(round(self.height * self.raster_scale))
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        cr = cairo.Context(surface)
+        cr.scale(self.raster_scale, self.raster_scale)
+        self.renderer.render_slide(cr, self.width, self.height, slide,
+                                   resolution=self.raster_scale)
+        surface.flush()
+        return width, height, surface.get_stride(), str(surface.get_data())
     
     
 class SVGExport(Export):
     """Exports slides to SVG files."""
     
-    def __init__(self, presentation, filename="svgfile", geometry=(640, 480)):
-        """Creates a SVG export object."""
-        Export.__init__(self, presentation, filename, geometry)
+    extension = "svg"
+    
+    def __init__(self, presentation, filename="svgfile", geometry=(640, 480),
+                 processes=1, incremental=False, external_images=False,
+                 rasterise_backgrounds=False):
+        """Creates a SVG export object.
+        
+        By default each SVG file is self-contained. With either image option,
+        the asset files are written to I{filename-assets/}; incremental
+        exports delete the asset files no slide refers to anymore.
+        
+        @type  external_images:       bool
+        @param external_images:       Write each distinct image once, scaled to
+                                      the size it is shown at, into the asset
+                                      directory and link it from the SVG
+                                      files instead of inlining it. Asset
+                                      names include the mtime and size of the
+                                      image, so edited images get new files.
+        @type  rasterise_backgrounds: bool
+        @param rasterise_backgrounds: Flatten the background layer of slides
+                                      showing images into one bitmap of the
+                                      slide size; text stays vector graphics.
+                                      Implies C{external_images}.
+        """
+        Export.__init__(self, presentation, filename, geometry, processes,
+                        incremental)
+        self.external_images = external_images
+        self.rasterise_backgrounds = rasterise_backgrounds
+        self.asset_dir = "%s-assets" % filename
     
     def render(self):
-        for index, slide in enumerate(self.slides):
-            surface = cairo.SVGSurface("%s-%d.svg" % (self.filename, index),
-                                       self.width, self.height)
-            cr = cairo.Context(surface)
-            self.renderer.render_slide(cr, self.width, self.height, slide)
+        errors = Export.render(self)
+        if self.incremental:
+            self.prune_assets()
+        return errors
+    
+    def export_slide(self, index, slide):
+        surface = cairo.SVGSurface(self.slide_filename(index, "svg"),
+                                   self.width, self.height)
+        cr = cairo.Context(surface)
+        linked = []
+        try:
+            if self.rasterise_backgrounds and self.renderer.slide_assets(slide):
+                background = self.background_surface(slide)
+                linked.append(background)
+                cr.set_source_surface(background, 0, 0)
+                cr.paint()
+                self.renderer.render_text(cr, self.width, self.height, slide)
+            else:
+                if self.external_images:
+                    self.link_images(slide, linked)
+                self.renderer.render_slide(cr, self.width, self.height, slide,
+                                           resolution=1.)
+            surface.finish()
+        finally:
+            # the image surfaces are shared with the image cache; other
+            # users of the cache must not get the links
+            for image in linked:
+                image.set_mime_data(cairo.MIME_TYPE_URI, None)
+    
+    def link_images(self, slide, linked):
+        """Links the images of C{slide}, at the size they are shown at, to
+        asset files. The renderer gets the same surfaces from the image cache,
+        so cairo references the files instead of inlining the pixels.
+        
+        @type  linked: list
+        @param linked: The linked surfaces are appended to it.
+        """
+        for path in self.renderer.slide_assets(slide):
+            name, width, height = self.image_asset(path)
+            image = imageloader.sized_image_surface(path, width, height)
+            linked.append(image)
+            self.link(image, name)
+    
+    def background_surface(self, slide):
+        """Returns the background layer of C{slide} as a bitmap of the slide
+        size, linked to an asset file. Slides showing the same images share
+        the bitmap."""
+        name = self.background_asset(slide)
+        background = cairo.ImageSurface(cairo.FORMAT_RGB24, self.width, self.height)
+        if not os.path.exists(os.path.join(self.asset_dir, name)):
+            cr = cairo.Context(background)
+            self.renderer.render_background(cr, self.width, self.height, slide,
+                                            resolution=1.)
+        # once the file exists, cairo only needs the size of the surface
+        self.link(background, name)
+        return background
+    
+    def image_asset(self, path):
+        """Returns C{(name, width, height)} of the asset file of image
+        C{path} at the size it is shown at."""
+        iw, ih = imageloader.image_size(path)
+        sf = self.renderer.image_geometry(iw, ih, self.width, self.height)[0]
+        width, height = imageloader.target_size(iw, ih, sf)
+        return ("%s-%dx%d.png" % (self.asset_digest([path]), width, height),
+                width, height)
+    
+    def background_asset(self, slide):
+        """Returns the name of the asset file of C{slide}'s background."""
+        return "bg-%s-%dx%d.png" % (self.asset_digest(self.renderer.slide_assets(slide)),
+                                    self.width, self.height)
+    
+    def asset_names(self, slide):
+        """Returns the names of the asset files C{slide} refers to."""
+        paths = self.renderer.slide_assets(slide)
+        if self.rasterise_backgrounds and paths:
+            return [self.background_asset(slide)]
+        elif self.external_images:
+            return [self.image_asset(path)[0] for path in paths]
+        return []
+    
+    def prune_assets(self):
+        """Deletes the asset files no slide refers to. Keeps all of them if
+        the names of some slide's assets can't be told, e.g. because an
+        image is missing."""
+        if not os.path.isdir(self.asset_dir):
+            return
+        used = set()
+        try:
+            for slide in self.slides:
+                used.update(self.asset_names(slide))
+        except (IOError, OSError):
+            return
+        for name in os.listdir(self.asset_dir):
+            if name.endswith('.png') and name not in used:
+                os.remove(os.path.join(self.asset_dir, name))
+    
+    def asset_digest(self, paths):
+        """Returns a short hash of the images C{paths}, their mtimes and
+        sizes (see L{diskcache.asset_key})."""
+        assets = [diskcache.asset_key(os.path.abspath(path)) for path in paths]
+        return hashlib.sha1(json.dumps(assets)).hexdigest()[:16]
+    
+    def slide_key(self, index):
+        """Adds the image options to L{Export.slide_key}, as they change
+        the SVG output."""
+        key = Export.slide_key(self, index)
+        key['external_images'] = self.external_images
+        key['rasterise_backgrounds'] = self.rasterise_backgrounds
+        return key
+    
+    def link(self, surface, name):
+        """Writes C{surface} to the asset file C{name} unless it exists, and
+        makes cairo's SVG backend reference that file for C{surface}."""
+        filename = os.path.join(self.asset_dir, name)
+        if not os.path.exists(filename):
+            if not os.path.isdir(self.asset_dir):
+                try:
+                    os.makedirs(self.asset_dir)
+                except OSError:
+                    pass    # created by another worker meanwhile
+            temp = "%s.%d.tmp" % (filename, os.getpid())
+            surface.write_to_png(temp)
+            os.rename(temp, filename)
+        uri = os.path.relpath(filename, os.path.dirname(self.filename) or os.curdir)
+        surface.set_mime_data(cairo.MIME_TYPE_URI, uri.replace(os.sep, '/'))
 
 
 class PNGExport(Export):
     """Exports slides to PNG files."""
     
-    def __init__(self, presentation, filename="pngfile", geometry=(1024, 768)):
+    extension = "png"
+    
+    def __init__(self, presentation, filename="pngfile", geometry=(1024, 768),
+                 processes=1, incremental=False):
         """Creates a PNG export object."""
-        Export.__init__(self, presentation, filename, geometry)
+        Export.__init__(self, presentation, filename, geometry, processes,
+                        incremental)
     
-    def render(self):
-        for index, slide in enumerate(self.slides):
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                         self.width, self.height)
-            cr = cairo.Context(surface)
-            self.renderer.render_slide(cr, self.width, self.height, slide)
-            surface.write_to_png("%s-%d.png" % (self.filename, index))
+    def export_slide(self, index, slide):
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     self.width, self.height)
+        cr = cairo.Context(surface)
+        self.renderer.render_slide(cr, self.width, self.height, slide)
+        surface.write_to_png(self.slide_filename(index, "png"))
             
             
 class PILExport(Export):
     """Exports slides through PIL."""
         
-    def __init__(self, presentation, extension, filename="pilfile", geometry=(1024, 768)):
+    def __init__(self, presentation, extension, filename="pilfile", geometry=(1024, 768),
+                 processes=1, incremental=False):
         """Creates a PIL export object.
         
         @param slides:    The slides to export.
@@ -94,27 +543,182 @@ class PILExport(Export):
         @param extension: Filename extension. Will decide on image format.
         @type  geometry:  tuple
         @param geometry:  (width, height)
+        @type  processes: int
+        @param processes: Number of worker processes, see L{Export}.
+        @type  incremental: bool
+        @param incremental: Skip unchanged slides, see L{Export.render}.
         """
-        Export.__init__(self, presentation, filename, geometry)
+        Export.__init__(self, presentation, filename, geometry, processes,
+                        incremental)
         self.extension = extension
     
-    def render(self):
+    def export_slide(self, index, slide):
         import Image
         
-        for index, slide in enumerate(self.slides):
-            surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
-                                         self.width, self.height)
-            cr = cairo.Context(surface)
-            self.renderer.render_slide(cr, self.width, self.height, slide)
-            
-            image = Image.fromstring("RGBA", (self.width, self.height), surface.get_data())
-           
-            # swap B and R channel
-            # TODO: why do we need this?!
-            r, g, b, a = image.split()
-            image = Image.merge('RGBA', (b, g, r, a))
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     self.width, self.height)
+        cr = cairo.Context(surface)
+        self.renderer.render_slide(cr, self.width, self.height, slide)
+        
+        image = Image.fromstring("RGBA", (self.width, self.height), surface.get_data())
+       
+        # swap B and R channel
+        # TODO: why do we need this?!
+        r, g, b, a = image.split()
+        image = Image.merge('RGBA', (b, g, r, a))
+
+        image.save(self.slide_filename(index, self.extension))
+    
+    
+class VideoExport(Export):
+    """Exports the talk as a stream of video frames.
+    
+    Each slide is shown for C{slide_duration} seconds. Slides the
+    presentation shows with a transition (see C{show_transition}) are joined
+    by the GUI's fade through black, hard cuts join the others. Every slide
+    is rendered once; fade frames are blended from the rendered buffers.
+    
+    Frames are written as YUV4MPEG2 (C{"y4m"}, 4:4:4) or as raw 8 bit RGB
+    (C{"rgb"}, e.g. for C{ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r FPS
+    -i -}). Needs NumPy.
+    """
+    
+    def __init__(self, presentation, filename="video.y4m", geometry=(1024, 768),
+                 processes=1, format="y4m", fps=25, slide_duration=5.,
+                 transition_duration=TRANSITION_DURATION):
+        """Creates a video export object.
+        
+        Slides are rendered one after the other, so C{processes} is ignored.
+        
+        @type  filename:            string
+        @param filename:            Output file; C{"-"} writes to stdout, so
+                                    the stream can be piped into an encoder.
+        @type  format:              string
+        @param format:              C{"y4m"} or C{"rgb"}.
+        @type  fps:                 int
+        @param fps:                 Frames per second.
+        @type  slide_duration:      float
+        @param slide_duration:      Seconds each slide is shown, excluding
+                                    transitions.
+        @type  transition_duration: int
+        @param transition_duration: Length of a fade in ms.
+        """
+        Export.__init__(self, presentation, filename, geometry)
+        if format not in ('y4m', 'rgb'):
+            raise ValueError("unknown video format %r" % format)
+        self.format = format
+        self.fps = fps
+        self.slide_frames = max(1, int(round(slide_duration * fps)))
+        self.transition_frames = int(round(transition_duration / 1000. * fps))
+        self.frames = 0
+    
+    def render(self):
+        # fail before the output file is created, not at the first slide
+        try:
+            __import__('numpy')
+        except ImportError:
+            raise ImportError("video export needs NumPy")
+
+        self.check_assets()
+        self.errors = []
+        self.profiles = {}
+        self.frames = 0
+        if self.filename == '-':
+            out = sys.stdout
+        else:
+            out = open(self.filename, 'wb')
+        try:
+            if self.format == 'y4m':
+                out.write("YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C444\n" % (
+                        self.width, self.height, self.fps))
+            previous = None
+            for index, slide in enumerate(self.slides):
+                with profiling.profile() as self.profiles[index]:
+                    current = self.export_slide(index, slide)
+                if previous is not None and \
+                   self.presentation.show_transition(index - 1, index):
+                    self.write_transition(out, previous, current)
+                frame = self.blend(current, 1.)
+                for i in range(self.slide_frames):
+                    self.write_frame(out, frame)
+                previous = current
+        finally:
+            if out is sys.stdout:
+                out.flush()
+            else:
+                out.close()
+        print >> sys.stderr, "%s: %d frames, %.1f s at %d fps" % (
+                self.filename, self.frames, float(self.frames) / self.fps, self.fps)
+        self.report_profiles()
+        return self.errors
+    
+    def export_slide(self, index, slide):
+        """Renders a slide and returns its pixels as a float32 array without
+        the format's offset (see L{blend}): C{(height, width, 3)} RGB for
+        C{"rgb"}, C{(3, height, width)} planes for C{"y4m"}."""
+        import numpy
+        
+        surface = cairo.ImageSurface(cairo.FORMAT_RGB24, self.width, self.height)
+        profiling.allocated(profiling.COMPOSITE, imageloader.surface_bytes(surface))
+        cr = cairo.Context(surface)
+        self.renderer.render_slide(cr, self.width, self.height, slide)
+        surface.flush()
+        pixels = numpy.ndarray((self.height, self.width, 4), numpy.uint8,
+                               surface.get_data(),
+                               strides=(surface.get_stride(), 4, 1))
+        rgb = pixels[..., _RGB].astype(numpy.float32)
+        if self.format == 'rgb':
+            return rgb
+        ycbcr = numpy.dot(rgb, numpy.array(_YCBCR, numpy.float32).T / 255.)
+        return numpy.ascontiguousarray(ycbcr.transpose(2, 0, 1))
+    
+    def blend(self, signal, alpha):
+        """Returns the frame of a slide faded to C{alpha} over black."""
+        import numpy
+        
+        frame = signal * alpha
+        if self.format == 'y4m':
+            frame += numpy.array([16., 128., 128.], numpy.float32)[:, numpy.newaxis, numpy.newaxis]
+        frame += .5
+        return frame.astype(numpy.uint8)
+    
+    def write_transition(self, out, from_signal, to_signal):
+        """Writes the frames of a fade through black, like the GUI's."""
+        for i in range(self.transition_frames):
+            progress = (i + .5) / self.transition_frames
+            if fade_to_next(progress):
+                signal = to_signal
+            else:
+                signal = from_signal
+            self.write_frame(out, self.blend(signal, fade_alpha(progress)))
+    
+    def write_frame(self, out, frame):
+        if self.format == 'y4m':
+            out.write("FRAME\n")
+        out.write(frame.tostring())
+        self.frames += 1
     
-            image.save("%s-%d.%s" % (self.filename, index, self.extension))
+    
+def create(presentation, format, filename, geometry, **options):
+    """Creates the export object for C{format}.
+    
+    @type  format:   string
+    @param format:   C{"pdf"}, C{"svg"}, C{"png"}, C{"y4m"} or C{"rgb"}
+                     (video, see L{VideoExport}) or any extension PIL can
+                     write (e.g. C{"jpg"}).
+    @type  filename: string
+    @param filename: Output filename for PDF, basename for all others.
+    @param options:  Passed on to the export class, e.g. C{processes}.
+    """
+    if format == 'pdf':
+        return PDFExport(presentation, filename, geometry, **options)
+    elif format == 'svg':
+        return SVGExport(presentation, filename, geometry, **options)
+    elif format == 'png':
+        return PNGExport(presentation, filename, geometry, **options)
+    elif format in ('y4m', 'rgb'):
+        return VideoExport(presentation, filename, geometry, format=format, **options)
+    return PILExport(presentation, format, filename, geometry, **options)
     
     
 def main():
@@ -131,9 +735,8 @@ def main():
     png = PNGExport(presentation)
     png.render()
     
-    # these get really huge :-\
-#    svg = SVGExport(presentation)
-#    svg.render()
+    svg = SVGExport(presentation)
+    svg.render()
     
     jpg = PILExport(presentation, "jpg")
     jpg.render()
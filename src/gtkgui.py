@@ -2,7 +2,12 @@
 
 """GTK GUI for CairoPresent."""
 
+import math
 import os
+import sys
+import time
+import traceback
+from optparse import OptionParser
 from threading import Thread
 
 import cairo
@@ -10,20 +15,439 @@ import pygtk
 pygtk.require('2.0')
 import gobject
 import gtk
+import pango
+import pangocairo
 
 import cairopresent
+from cairopresent.helpers.diskcache import DiskCache, DiskCacheWriter
+from cairopresent.helpers import assets, imageloader, profiling
+from cairopresent.helpers.layoutcache import font_description, layout_cache
+from cairopresent.helpers.prefetch import Prefetcher
 from cairopresent.helpers.resources import *
+from cairopresent.helpers.slidecache import SlideCache
+from cairopresent.helpers.transition import TRANSITION_DURATION, fade_alpha, fade_to_next
 
 
 TRANSITION_TIMEOUT = 50 # ms steps between fade gradients
-TRANSITION_STEP = 0.2  # alpha delta between fade gradients
+TRANSITION_LATE = 1.5   # a frame is late after this many TRANSITION_TIMEOUTs
+TRANSITION_STATS = 100  # number of finished transitions to keep stats for
+PREFETCH_DEPTH = 1      # slides to prefetch in each direction
+PREFETCH_WORKERS = 1    # prefetch worker threads
+SLIDE_CACHE_BYTES = 128 * 1024 * 1024   # memory budget for rendered slides
+RESIZE_DEBOUNCE = 150   # ms without resizing before rendering at the new size
+THUMBNAIL_WIDTH = 192   # px, the height follows the window's aspect ratio
+THUMBNAIL_PADDING = 12  # px around thumbnails in the overview
+THUMBNAIL_BATCH = 6     # thumbnails scaled from the slide cache per idle callback
+THUMBNAIL_WORKERS = 1   # threads rendering thumbnails of uncached slides
+MAX_THUMBNAILS = 600    # thumbnails kept in memory (~64 MB at 4:3)
 
 gtk.gdk.threads_init()
 
+class Transition(object):
+    """A fade-out/fade-in from one slide to another.
+
+    The fade is driven by the time elapsed since it started, not by the
+    number of frames drawn, so slow frames shorten the fade instead of
+    stretching it.
+    """
+
+    def __init__(self, from_index, to_index, duration=TRANSITION_DURATION):
+        """Starts a transition.
+
+        @type  duration: int
+        @param duration: Length of fade-out plus fade-in in ms.
+        """
+        self.from_index = from_index
+        self.to_index = to_index
+        self.duration = duration / 1000.
+        self.start = time.time()
+        self.frames = 0
+        self.late_frames = 0
+        self.skipped_ticks = 0
+        self.draw_time = 0.     # total time spent drawing frames
+        self.max_draw_time = 0.
+        self._last_frame = self.start
+
+    def progress(self):
+        """Returns the elapsed fraction of the transition, from 0 to 1."""
+        return min(1., (time.time() - self.start) / self.duration)
+
+    def slide_index(self):
+        """Returns the slide to show at the current point of the fade."""
+        if fade_to_next(self.progress()):
+            return self.to_index
+        return self.from_index
+
+    def alpha(self):
+        """Returns the opacity of the slide, 1 at both ends of the fade and 0
+        in the middle."""
+        return fade_alpha(self.progress())
+
+    def finished(self):
+        return self.progress() >= 1.
+
+    def record_frame(self, draw_time):
+        """Records a drawn frame that took C{draw_time} seconds."""
+        now = time.time()
+        if now - self._last_frame > TRANSITION_LATE * TRANSITION_TIMEOUT / 1000.:
+            self.late_frames += 1
+        self._last_frame = now
+        self.frames += 1
+        self.draw_time += draw_time
+        self.max_draw_time = max(self.max_draw_time, draw_time)
+
+    def stats(self):
+        """Returns a dict of frame statistics."""
+        elapsed = max(time.time() - self.start, 1e-6)
+        return {'frames': self.frames, 'fps': self.frames / elapsed,
+                'late_frames': self.late_frames,
+                'skipped_ticks': self.skipped_ticks,
+                'mean_draw_ms': self.frames and 1000 * self.draw_time / self.frames,
+                'max_draw_ms': 1000 * self.max_draw_time}
+
+
+class Overview(gtk.ScrolledWindow):
+    """A scrollable grid of thumbnails of all slides.
+    
+    Thumbnails are built visible ones first, so the grid fills in without
+    blocking input. A slide that is in the main window's slide cache is
+    scaled down from there in small batches from idle callbacks; any other
+    slide is rendered at thumbnail size, which only needs small image
+    pyramid levels, by a L{Prefetcher} of its own and handed to the main
+    loop when done. Clicking a thumbnail jumps to the slide.
+    """
+    
+    def __init__(self, main_window):
+        gtk.ScrolledWindow.__init__(self)
+        self.main_window = main_window
+        self.thumbnails = {}        # slide index -> surface, None if rendering failed
+        self.thumbnail_size = None
+        self.columns = 1
+        self._building = False
+        # separate from the main window's prefetcher, whose jobs would
+        # otherwise be replaced by thumbnail jobs and vice versa
+        self.prefetcher = Prefetcher(self.render_thumbnail, self.on_rendered,
+                                     THUMBNAIL_WORKERS)
+        
+        self.set_policy(gtk.POLICY_NEVER, gtk.POLICY_AUTOMATIC)
+        self.area = gtk.DrawingArea()
+        self.area.set_events(gtk.gdk.EXPOSURE_MASK | gtk.gdk.BUTTON_PRESS_MASK)
+        self.add_with_viewport(self.area)
+        
+        self.connect('size_allocate', self.on_size_allocate)
+        self.get_vadjustment().connect('value_changed', self.on_scroll)
+        self.area.connect('expose_event', self.expose)
+        self.area.connect('button_press_event', self.on_button_press)
+    
+    def open(self, geometry):
+        """Prepares the grid for slides of C{geometry} and scrolls to the
+        current slide."""
+        width, height = geometry
+        size = (THUMBNAIL_WIDTH, max(1, THUMBNAIL_WIDTH * height // width))
+        if size != self.thumbnail_size:
+            self.thumbnail_size = size
+            self.thumbnails.clear()
+        self.relayout()
+        # the scroll range is known once the grid has been allocated
+        gobject.idle_add(self.scroll_to, self.main_window.current_slide_index)
+        self.area.queue_draw()
+    
+    def scroll_to(self, index):
+        """Scrolls the row of thumbnail C{index} to the top of the view."""
+        adjustment = self.get_vadjustment()
+        adjustment.set_value(min(self.cell(index)[1] - THUMBNAIL_PADDING,
+                                 max(0, adjustment.upper - adjustment.page_size)))
+        return False
+    
+    def relayout(self):
+        """Fits the number of columns to the width of the view."""
+        if self.thumbnail_size is None:
+            return
+        tw, th = self.thumbnail_size
+        width = self.get_allocation().width
+        self.columns = max(1, (width - THUMBNAIL_PADDING) // (tw + THUMBNAIL_PADDING))
+        rows = int(math.ceil(len(self.main_window.slides) / float(self.columns)))
+        height = rows * (th + THUMBNAIL_PADDING) + THUMBNAIL_PADDING
+        if self.area.get_size_request()[1] != height:
+            self.area.set_size_request(-1, height)
+    
+    def cell(self, index):
+        """Returns the C{(x, y)} position of thumbnail C{index}."""
+        tw, th = self.thumbnail_size
+        margin = (self.area.get_allocation().width -
+                  self.columns * (tw + THUMBNAIL_PADDING) - THUMBNAIL_PADDING) // 2
+        return (max(0, margin) + THUMBNAIL_PADDING +
+                (index % self.columns) * (tw + THUMBNAIL_PADDING),
+                THUMBNAIL_PADDING + (index // self.columns) * (th + THUMBNAIL_PADDING))
+    
+    def index_at(self, x, y):
+        """Returns the index of the thumbnail at C{(x, y)}, or C{None}."""
+        tw, th = self.thumbnail_size
+        for index in self.visible_indices(y, y + 1):
+            cx, cy = self.cell(index)
+            if cx <= x < cx + tw and cy <= y < cy + th:
+                return index
+        return None
+    
+    def visible_indices(self, top, bottom):
+        """Returns the indices of the thumbnails in the rows between C{top}
+        and C{bottom}."""
+        row_height = self.thumbnail_size[1] + THUMBNAIL_PADDING
+        first = max(0, int(top) // row_height)
+        last = int(bottom) // row_height
+        return range(first * self.columns,
+                     min(len(self.main_window.slides), (last + 1) * self.columns))
+    
+    def on_size_allocate(self, widget, allocation):
+        self.relayout()
+    
+    def on_scroll(self, adjustment):
+        self.build()
+    
+    def on_button_press(self, area, event):
+        if event.type == gtk.gdk.BUTTON_PRESS and event.button == 1:
+            index = self.index_at(event.x, event.y)
+            if index is not None:
+                self.main_window.jump(index)
+        return True
+    
+    def expose(self, area, event):
+        """Callback for expose-event; paints the thumbnails in C{event.area}."""
+        if self.thumbnail_size is None:
+            return False
+        tw, th = self.thumbnail_size
+        cr = area.window.cairo_create()
+        x, y, width, height = event.area
+        cr.rectangle(x, y, width, height)
+        cr.clip()
+        cr.set_source_rgb(.15, .15, .15)
+        cr.paint()
+        
+        cr.select_font_face('sans')
+        cr.set_font_size(11)
+        for index in self.visible_indices(y, y + height):
+            cx, cy = self.cell(index)
+            thumbnail = self.thumbnails.get(index)
+            if thumbnail is None:
+                cr.rectangle(cx, cy, tw, th)
+                cr.set_source_rgb(.3, .3, .3)
+                cr.fill()
+            else:
+                cr.set_source_surface(thumbnail, cx, cy)
+                cr.paint()
+            if index == self.main_window.current_slide_index:
+                cr.rectangle(cx - 2, cy - 2, tw + 4, th + 4)
+                cr.set_source_rgb(1, 1, 1)
+                cr.set_line_width(2)
+                cr.stroke()
+            cr.move_to(cx, cy + th + THUMBNAIL_PADDING - 2)
+            cr.set_source_rgb(.8, .8, .8)
+            cr.show_text(str(index + 1))
+        self.build()
+        return False
+    
+    def build(self):
+        """Starts building missing thumbnails in the background."""
+        if not self._building and self.thumbnail_size is not None:
+            self._building = True
+            gobject.idle_add(self.build_batch)
+    
+    def build_batch(self):
+        """Scales up to C{THUMBNAIL_BATCH} thumbnails down from the slide
+        cache and schedules rendering the others, for the visible slides,
+        then those of the pages above and below. Runs on the main loop."""
+        adjustment = self.get_vadjustment()
+        top, page = adjustment.value, adjustment.page_size
+        missing = [index for index in
+                   self.visible_indices(top, top + page) +
+                   self.visible_indices(top + page, top + 2 * page) +
+                   self.visible_indices(top - page, top)
+                   if index not in self.thumbnails]
+        if not missing or not self.get_property('visible'):
+            self.prefetcher.schedule([])
+            self._building = False
+            return False
+        
+        tw, th = self.thumbnail_size
+        rendering = []
+        scaled = 0
+        for index in missing:
+            surface = self.main_window.cache.lookup(index)[1]
+            if surface is None:
+                rendering.append((index, tw, th))
+            elif scaled < THUMBNAIL_BATCH:
+                self.publish((index, tw, th), imageloader.scale_surface(surface, tw, th))
+                scaled += 1
+        self.prefetcher.schedule(rendering)
+        self.shrink(top + page / 2)
+        if scaled < THUMBNAIL_BATCH:
+            # the rest is up to the worker, whose results trigger a new build
+            self._building = False
+            return False
+        return True
+    
+    def render_thumbnail(self, key):
+        """Renders a thumbnail job C{(index, width, height)}; called on a
+        worker thread."""
+        index, tw, th = key
+        try:
+            thumbnail = cairo.ImageSurface(cairo.FORMAT_RGB24, tw, th)
+            self.main_window.renderer.render_slide(cairo.Context(thumbnail), tw, th,
+                                                   self.main_window.slides[index])
+            return thumbnail
+        except Exception:
+            traceback.print_exc()
+            gobject.idle_add(self.publish, key, None)     # don't try again
+            return None
+    
+    def on_rendered(self, key, surface):
+        """Called on a worker thread when a thumbnail is done."""
+        gobject.idle_add(self.publish, key, surface)
+    
+    def publish(self, key, surface):
+        """Stores a thumbnail, C{None} if rendering failed, and redraws its
+        cell; runs on the main loop."""
+        index, tw, th = key
+        if (tw, th) == self.thumbnail_size:    # else the window was resized meanwhile
+            self.thumbnails[index] = surface
+            cx, cy = self.cell(index)
+            self.area.queue_draw_area(cx, cy, tw, th)
+        return False
+    
+    def shrink(self, centre):
+        """Drops the thumbnails farthest from C{centre} (a y coordinate)
+        beyond C{MAX_THUMBNAILS}."""
+        if len(self.thumbnails) <= MAX_THUMBNAILS:
+            return
+        row_height = self.thumbnail_size[1] + THUMBNAIL_PADDING
+        centre_index = int(centre) // row_height * self.columns
+        indices = sorted(self.thumbnails, key=lambda index: abs(index - centre_index))
+        for index in indices[MAX_THUMBNAILS:]:
+            del self.thumbnails[index]
+
+
+class PresenterWindow(gtk.Window):
+    """Presenter view of a C{MainWindow}: the current and the next slide,
+    the source text of the current slide and the elapsed time.
+    
+    Both slides are scaled down from the surfaces rendered for the audience
+    window, so nothing is rendered twice; keys are handled by the audience
+    window, and either window redraws the other when the slide changes.
+    """
+    
+    def __init__(self, main_window):
+        gtk.Window.__init__(self)
+        self.set_title("CairoPresent - Presenter")
+        self.set_icon_from_file(get_res('icon.png'))
+        self.set_default_size(1024, 600)
+        self.main_window = main_window
+        self.start = time.time()
+        
+        self.drawing_area = gtk.DrawingArea()
+        self.add(self.drawing_area)
+        self.connect('key_press_event', main_window.on_key_press)
+        self.connect('destroy', self.on_destroy)
+        self.drawing_area.connect('expose_event', self.expose)
+        gobject.timeout_add(1000, self.tick)
+        self.show_all()
+    
+    def probe_assets(self):
+        """Probes the images of the presentation; runs on a background
+        thread."""
+        report = assets.probe_assets(self.presentation)
+        if report.errors:
+            gobject.idle_add(self.report_assets, report)
+
+    def report_assets(self, report):
+        """Prints the broken images of an L{assets.AssetReport}; runs on the
+        main loop."""
+        print >> sys.stderr, "%d broken image(s):\n%s" % (
+                len(report.errors), report.format_errors())
+        return False
+
+    def on_destroy(self, win):
+        if self.main_window.presenter is self:
+            self.main_window.presenter = None
+    
+    def tick(self):
+        """Redraws the clock once a second."""
+        if self.drawing_area.window is None:
+            return False
+        self.drawing_area.queue_draw()
+        return True
+    
+    def expose(self, drawing_area, event):
+        """Callback for expose-event."""
+        main = self.main_window
+        width, height = drawing_area.window.get_size()
+        cr = drawing_area.window.cairo_create()
+        cr.set_source_rgb(.1, .1, .1)
+        cr.paint()
+        
+        index = main.target_index()
+        margin = 16
+        column = (width - 3 * margin) // 2
+        self.paint_preview(cr, index, margin, margin, column * 1.2, height * .6)
+        self.paint_preview(cr, index + 1, 2 * margin + column * 1.2, margin,
+                           column * .8, height * .4)
+        
+        source = main.renderer.slide_source(main.slides[index])
+        elapsed = int(time.time() - self.start)
+        status = 'slide %d / %d    %d:%02d' % (index + 1, len(main.slides),
+                                              elapsed // 60, elapsed % 60)
+        # Pango isn't thread-safe and the prefetch workers lay out text too
+        with layout_cache.lock:
+            pc = pangocairo.CairoContext(cr)
+            layout = pc.create_layout()
+            layout.set_font_description(font_description("Sans", 14))
+            layout.set_width(int((width - 2 * margin) * pango.SCALE))
+            layout.set_text(source)
+            cr.move_to(margin, height * .6 + 2 * margin)
+            cr.set_source_rgb(.9, .9, .9)
+            pc.show_layout(layout)
+            
+            layout.set_text(status)
+            cr.move_to(margin, height - margin - layout.get_pixel_size()[1])
+            pc.show_layout(layout)
+        return False
+    
+    def paint_preview(self, cr, index, x, y, width, height):
+        """Paints slide C{index} as rendered for the audience window, scaled
+        to fit the given box; an outline if it isn't rendered yet."""
+        main = self.main_window
+        if not 0 <= index < len(main.slides):
+            return
+        surface = main.cache.lookup(index)[1]
+        if surface is None:
+            cr.rectangle(x, y, width, height)
+            cr.set_source_rgb(.4, .4, .4)
+            cr.set_line_width(1)
+            cr.stroke()
+            return
+        sf = min(width / surface.get_width(), height / surface.get_height())
+        cr.save()
+        cr.translate(x, y)
+        cr.scale(sf, sf)
+        cr.set_source_surface(surface)
+        cr.get_source().set_filter(cairo.FILTER_GOOD)
+        cr.paint()
+        cr.restore()
+
+
 class MainWindow(gtk.Window):
     """Main presentation window."""
     
-    def __init__(self, presentation):
+    def __init__(self, presentation, prefetch_depth=PREFETCH_DEPTH,
+                 prefetch_workers=PREFETCH_WORKERS,
+                 cache_bytes=SLIDE_CACHE_BYTES, disk_cache=False, presenter=False):
+        """Creates the presentation window.
+        
+        @param disk_cache: A C{DiskCache} to load rendered slides from and
+                           store them in; C{True} uses the default cache
+                           directory. Off by default.
+        @type  presenter:  bool
+        @param presenter:  Open a L{PresenterWindow} as well; C{p} toggles it.
+        """
         gtk.Window.__init__(self)
         
         self.set_title("CairoPresent")
@@ -33,30 +457,89 @@ class MainWindow(gtk.Window):
         self.slides = presentation.slides
         self.current_slide_index = 0
         self.goto_buffer = None
+        # report broken images early rather than when their slide comes up;
+        # probed in the background, as that loads every slide of a lazy deck
+        prober = Thread(target=self.probe_assets, name='probe-assets')
+        prober.daemon = True
+        prober.start()
+
+        self.current_transition = None
+        self.transition_stats = []  # stats of the last finished transitions
+        self._draw_pending = False
 
-        self.in_transition = 0  # 1 to fade in; -1 to fade out
-        self.transition_alpha = 0
-        self.transition_next_index = None
+        self._geometry = None       # size of the drawing area
+        self._resizing = False      # showing scaled previews until the size settles
+        self._last_resize = 0.
 
-        self.cache = {}
+        self.show_hud = False       # performance overlay, toggled with 'i'
+        self.frame_time = 0.        # seconds spent drawing the last frame
+        self.render_profiles = {}   # slide index -> profile of its last rendering
+
+        self.cache = SlideCache(cache_bytes)
+        if disk_cache is True:
+            disk_cache = DiskCache()
+        self.disk_cache = disk_cache or None
+        self.disk_writer = None
+        if self.disk_cache is not None:
+            self.disk_writer = DiskCacheWriter(self.disk_cache)
+        self.prefetched = set()     # keys published by the prefetcher, not shown yet
+        self.server_surfaces = {}   # (index, geometry) -> (cached surface, server-side copy)
         
         self.renderer = presentation.renderer
+        self.prefetcher = Prefetcher(self.render_prefetch, self.on_prefetched,
+                                     prefetch_workers, prefetch_depth)
         
         self.set_default_size(800, 600)
         self._is_fullscreen = False
         
         self.drawing_area = gtk.DrawingArea()
-        self.add(self.drawing_area)
+        self.overview = Overview(self)
+        self.overview.set_no_show_all(True)
+        box = gtk.VBox()
+        box.pack_start(self.drawing_area)
+        box.pack_start(self.overview)
+        self.add(box)
         
         self.set_events(gtk.gdk.EXPOSURE_MASK | gtk.gdk.BUTTON_PRESS_MASK)
 
-        self.connect('destroy', gtk.main_quit)
+        self.connect('destroy', self.on_destroy)
         self.connect('button_press_event', self.on_button_press)
         self.connect('key_press_event', self.on_key_press)
         self.connect('window_state_event', self.on_window_state)
+        self.drawing_area.connect('configure_event', self.on_configure)
         self.drawing_area.connect('expose_event', self.expose)
         
         self.show_all()
+        
+        self.presenter = None
+        if presenter:
+            self.toggle_presenter()
+
+    def on_destroy(self, win):
+        """Callback for destroy."""
+        if self.presenter is not None:
+            self.presenter.destroy()
+        self.prefetcher.stop()
+        self.overview.prefetcher.stop()
+        print >> sys.stderr, 'prefetch:', ', '.join(
+                '%s=%s' % item for item in sorted(self.prefetcher.stats().items()))
+        print >> sys.stderr, 'slide cache:', ', '.join(
+                '%s=%s' % item for item in sorted(self.cache.stats().items()))
+        if self.disk_cache is not None:
+            self.disk_writer.stop()
+            stats = self.disk_cache.stats()
+            stats.update(dropped=self.disk_writer.dropped, failed=self.disk_writer.failed)
+            print >> sys.stderr, 'disk cache:', ', '.join(
+                    '%s=%s' % item for item in sorted(stats.items()))
+        if self.transition_stats:
+            count = len(self.transition_stats)
+            print >> sys.stderr, \
+                'transitions: count=%d, fps=%.1f, late_frames=%d, skipped_ticks=%d' % (
+                count,
+                sum(stats['fps'] for stats in self.transition_stats) / count,
+                sum(stats['late_frames'] for stats in self.transition_stats),
+                sum(stats['skipped_ticks'] for stats in self.transition_stats))
+        gtk.main_quit()
 
     def on_button_press(self, win, event):
         x, y, state = event.window.get_pointer()
@@ -66,11 +549,22 @@ class MainWindow(gtk.Window):
     def on_key_press(self, win, event):
         """Callback for key-press-event."""
         key = gtk.gdk.keyval_name(event.keyval)
-        if key in ('f', 'F', 'F5'):
+        if self.overview.get_property('visible'):
+            if key in ('o', 'O', 'Tab', 'Escape'):
+                self.toggle_overview()
+            return True
+        if key in ('o', 'O', 'Tab'):
+            self.toggle_overview()
+        elif key in ('p', 'P'):
+            self.toggle_presenter()
+        elif key in ('f', 'F', 'F5'):
             if self._is_fullscreen:
                 self.unfullscreen()
             else:
                 self.fullscreen()
+        elif key in ('i', 'I'):
+            self.show_hud = not self.show_hud
+            self.drawing_area.queue_draw()
         elif key in ('Right', 'space', 'Page_Down'):
             self.transition()
         elif key in ('Left', 'BackSpace', 'Page_Up'):
@@ -89,6 +583,7 @@ class MainWindow(gtk.Window):
                 self.goto_buffer = key
             else:
                 self.goto_buffer += key
+            self.prefetch()
         elif key in ('Return', 'g', 'G'):
             if self.goto_buffer is not None:
                 target = int(self.goto_buffer)-1
@@ -99,48 +594,301 @@ class MainWindow(gtk.Window):
         
         return True
     
+    def toggle_overview(self):
+        """Switches between the slide and the thumbnail overview."""
+        if self.overview.get_property('visible'):
+            self.overview.hide()
+            self.drawing_area.show()
+        else:
+            self.overview.open(self.drawing_area.window.get_size())
+            self.drawing_area.hide()
+            self.overview.show_all()
+    
+    def toggle_presenter(self):
+        """Opens or closes the presenter view."""
+        if self.presenter is None:
+            self.presenter = PresenterWindow(self)
+        else:
+            self.presenter.destroy()
+    
+    def target_index(self):
+        """Returns the slide being shown, or faded to."""
+        if self.current_transition is not None:
+            return self.current_transition.to_index
+        return self.current_slide_index
+    
+    def slide_changed(self):
+        """Redraws the presenter view after navigation or when a slide
+        surface it shows becomes available."""
+        if self.presenter is not None:
+            self.presenter.drawing_area.queue_draw()
+    
+    def jump(self, slide_index):
+        """Closes the overview and shows slide C{slide_index} without a
+        transition; its neighbours are prefetched right away."""
+        if self.overview.get_property('visible'):
+            self.toggle_overview()
+        self.current_transition = None
+        self.goto_buffer = None
+        self.current_slide_index = slide_index
+        self.prefetch()
+        self.drawing_area.queue_draw()
+        self.slide_changed()
+    
     def on_window_state(self, win, event):
         """Callback for window-state-event."""
         if self._is_fullscreen != bool(event.new_window_state & gtk.gdk.WINDOW_STATE_FULLSCREEN):
             self._is_fullscreen = bool(event.new_window_state & gtk.gdk.WINDOW_STATE_FULLSCREEN)
-            self.invalidate_cache()
+            # cached slides are keyed by geometry, old ones stay until replaced
+            self.drawing_area.queue_draw()
     
         return False
     
+    def on_configure(self, drawing_area, event):
+        """Callback for configure-event.
+        
+        While the size keeps changing, expose paints scaled previews of
+        cached slides; C{RESIZE_DEBOUNCE} ms after the last change, the
+        current slide and then its neighbours are rendered at the new size.
+        """
+        geometry = (event.width, event.height)
+        if geometry == self._geometry:
+            return False
+        initial = self._geometry is None
+        self._geometry = geometry
+        if initial:
+            return False    # nothing to preview, render right away
+        self._last_resize = time.time()
+        if not self._resizing:
+            self._resizing = True
+            gobject.timeout_add(RESIZE_DEBOUNCE, self.resize_callback)
+        return False
+
+    def resize_callback(self):
+        if time.time() - self._last_resize < RESIZE_DEBOUNCE / 1000.:
+            return True     # still resizing
+        self._resizing = False
+        # expose renders the current slide, then prefetches its neighbours;
+        # entries of the old size are dropped as they are replaced
+        self.drawing_area.queue_draw()
+        return False
+
     def expose(self, drawing_area, event):
         """Callback for expose-event."""
 
-        cr = drawing_area.window.cairo_create()
-        cr_width, cr_height = drawing_area.window.get_size()
+        self._draw_pending = False
+        start = time.time()
 
-        self.render_into_cache(self.current_slide_index)
-        current_slide = self.cache[self.current_slide_index]
+        geometry = drawing_area.window.get_size()
+        if self._resizing:
+            current_slide = self.preview_surface(self.current_slide_index)
+        else:
+            current_slide = self.render_into_cache(self.current_slide_index)
+        scaled = (current_slide.get_width(), current_slide.get_height()) != geometry
 
         cr = drawing_area.window.cairo_create()
-        cr.set_source_surface(current_slide)
-        cr.paint()
+        cr.rectangle(*event.area)   # only repaint the damaged region
+        cr.clip()
+        if scaled:
+            source = None   # a preview, painted straight from the image surface
+        else:
+            source = self.server_surface(cr.get_target(), self.current_slide_index,
+                                         geometry, current_slide)
 
-        if self.in_transition:
-            cr.set_source_rgba(0, 0, 0, self.transition_alpha)
+        transition = self.current_transition
+        if transition is None:
+            if source is None:
+                self.paint_slide(cr, current_slide, geometry)
+            else:
+                cr.set_source_surface(source)
+                cr.paint()
+            if not self._resizing:
+                self.prefetch()
+            self.slide_changed()    # the presenter view shows this surface
+        else:
+            # fade over black
+            cr.set_source_rgb(0, 0, 0)
             cr.paint()
+            if source is None:
+                cr.push_group()
+                self.paint_slide(cr, current_slide, geometry)
+                cr.pop_group_to_source()
+            else:
+                cr.set_source_surface(source)
+            cr.paint_with_alpha(transition.alpha())
+            transition.record_frame(time.time() - start)
+        
+        if self.show_hud:
+            self.paint_hud(cr)
+        self.frame_time = time.time() - start
        
         return False
 
-    def invalidate_cache(self):
-        self.cache = {}
+    def paint_hud(self, cr):
+        """Paints frame and render times over the slide."""
+        lines = ['frame %.1f ms' % (1000 * self.frame_time)]
+        profile = self.render_profiles.get(self.current_slide_index)
+        if profile is not None:
+            lines.append('slide %d: render %.1f ms, %d KB' % (
+                    self.current_slide_index + 1, 1000 * profile.wall,
+                    profile.total_bytes() // 1024))
+            lines.append('  ' + ', '.join('%s %.1f' % (name, 1000 * profile.times[name])
+                                          for name in profiling.PHASES))
+        stats = self.cache.stats()
+        lines.append('slide cache: %d hits, %d misses, %d KB' % (
+                stats['hits'], stats['misses'], stats['bytes'] // 1024))
+        lines.append('prefetch: %.0f%% hits' % (100 * self.prefetcher.stats()['hit_rate']))
+
+        cr.save()
+        cr.select_font_face('monospace')
+        cr.set_font_size(12)
+        line_height = 16
+        width = max(cr.text_extents(line)[4] for line in lines) + 16
+        cr.rectangle(0, 0, width, line_height * len(lines) + 8)
+        cr.set_source_rgba(0, 0, 0, .7)
+        cr.fill()
+        cr.set_source_rgb(1, 1, 1)
+        for number, line in enumerate(lines):
+            cr.move_to(8, 4 + line_height * (number + 1) - 4)
+            cr.show_text(line)
+        cr.restore()
+
+    def paint_slide(self, cr, surface, geometry):
+        """Paints a slide surface onto C{cr}, scaling it to C{geometry} if it
+        was rendered at another size."""
+        width, height = surface.get_width(), surface.get_height()
+        if (width, height) != geometry:
+            cr.save()
+            cr.scale(float(geometry[0]) / width, float(geometry[1]) / height)
+            cr.set_source_surface(surface)
+            cr.get_source().set_filter(cairo.FILTER_FAST)
+            cr.paint()
+            cr.restore()
+        else:
+            cr.set_source_surface(surface)
+            cr.paint()
+
+    def preview_surface(self, slide_index):
+        """Returns the surface of slide C{slide_index} at the current window
+        size if it is cached, else the slide at any cached size. Only
+        renders the slide if it isn't cached at all."""
+        geometry = self.drawing_area.window.get_size()
+        buffer = self.cache.get(slide_index, geometry)
+        if buffer is None:
+            buffer = self.cache.lookup(slide_index)[1]
+        if buffer is None:
+            buffer = self.render_into_cache(slide_index)
+        return buffer
+
+    def server_surface(self, target, slide_index, geometry, buffer):
+        """Returns a copy of the cached surface C{buffer} of slide
+        C{slide_index} that is similar to C{target}, e.g. an X pixmap, so
+        repainting it doesn't upload the pixels again.
+        
+        Copies are kept for the slides within prefetch distance of the
+        current one at the current size.
+        """
+        entry = self.server_surfaces.get((slide_index, geometry))
+        if entry is not None and entry[0] is buffer:
+            return entry[1]
+        similar = target.create_similar(cairo.CONTENT_COLOR, *geometry)
+        cr = cairo.Context(similar)
+        cr.set_operator(cairo.OPERATOR_SOURCE)
+        cr.set_source_surface(buffer)
+        cr.paint()
+        self.server_surfaces[(slide_index, geometry)] = (buffer, similar)
+        
+        reach = self.prefetcher.depth + 1
+        for key in self.server_surfaces.keys():
+            index, key_geometry = key
+            if key_geometry != geometry or \
+               (abs(index - self.current_slide_index) > reach and
+                index != self.target_index()):
+                del self.server_surfaces[key]
+        return similar
+    
+    def render_slide(self, slide_index, cr_width, cr_height):
+        """Renders slide C{slide_index} into a new ImageSurface, or maps it
+        from the disk cache. Safe to call from prefetch worker threads.
+        Phase timings end up in C{render_profiles}."""
+        current_slide_desc = self.slides[slide_index]
+        with profiling.profile() as profile:
+            buffer = None
+            if self.disk_cache is not None:
+                buffer = self.disk_cache.get(self.renderer, current_slide_desc,
+                                             (cr_width, cr_height))
+            if buffer is None:
+                buffer = cairo.ImageSurface(cairo.FORMAT_ARGB32, cr_width, cr_height)
+                profiling.allocated(profiling.COMPOSITE, imageloader.surface_bytes(buffer))
+                cr = cairo.Context(buffer)
+                self.renderer.render_slide(cr, cr_width, cr_height,
+                                           current_slide_desc)
+                if self.disk_writer is not None:
+                    # written on the writer's thread, nobody waits for the disk
+                    self.disk_writer.put(self.renderer, current_slide_desc,
+                                         (cr_width, cr_height), buffer)
+        self.render_profiles[slide_index] = profile
+        return buffer
 
     def render_into_cache(self, slide_index):
-        if slide_index in self.cache:
-            return
+        """Returns the surface of slide C{slide_index} at the current window
+        size, rendering it if it isn't cached."""
+        geometry = self.drawing_area.window.get_size()
+        self.cache.focus(self.current_slide_index, geometry)
+        buffer = self.cache.get(slide_index, geometry)
+        if buffer is not None:
+            if (slide_index, geometry) in self.prefetched:
+                self.prefetched.discard((slide_index, geometry))
+                self.prefetcher.count(True)
+            return buffer
+
+        cr_width, cr_height = geometry
+        # a worker may be rendering this very slide already
+        buffer = self.prefetcher.wait((slide_index, cr_width, cr_height))
+        self.prefetcher.count(buffer is not None)
+        if buffer is None:
+            buffer = self.render_slide(slide_index, cr_width, cr_height)
+        self.cache.put(slide_index, geometry, buffer)
+        return buffer
 
+    def prefetch(self):
+        """Schedules rendering of the neighbouring slides and the goto target."""
         cr_width, cr_height = self.drawing_area.window.get_size()
-        buffer = cairo.ImageSurface(cairo.FORMAT_ARGB32, cr_width, cr_height)
-        cr = cairo.Context(buffer)
-        cr_width, cr_height = buffer.get_width(), buffer.get_height()
-        current_slide_desc = self.slides[slide_index]
-        self.renderer.render_slide(cr, cr_width, cr_height,
-                                   current_slide_desc)
-        self.cache[slide_index] = buffer
+        indices = self.prefetcher.neighbours(self.current_slide_index,
+                                             len(self.slides))
+        if self.goto_buffer is not None:
+            target = int(self.goto_buffer)-1
+            if 0 <= target < len(self.slides):
+                indices.insert(0, target)
+        self.prefetcher.schedule([(index, cr_width, cr_height)
+                                  for index in indices
+                                  if (index, (cr_width, cr_height)) not in self.cache])
+
+    def render_prefetch(self, key):
+        """Renders a prefetch job; called on a worker thread."""
+        slide_index, cr_width, cr_height = key
+        return self.render_slide(slide_index, cr_width, cr_height)
+
+    def on_prefetched(self, key, surface):
+        """Called on a worker thread when a prefetch job is done."""
+        gobject.idle_add(self.publish_prefetched, key, surface)
+
+    def publish_prefetched(self, key, surface):
+        """Stores a prefetched surface in the cache; runs on the main loop."""
+        slide_index, cr_width, cr_height = key
+        geometry = (cr_width, cr_height)
+        if self.drawing_area.window is not None and \
+           self.drawing_area.window.get_size() == geometry and \
+           (slide_index, geometry) not in self.cache:
+            self.cache.put(slide_index, geometry, surface)
+            self.prefetched.add((slide_index, geometry))
+            if self.drawing_area.get_property('visible'):
+                # upload now, so the transition to it only blits server-side
+                self.server_surface(self.drawing_area.window.cairo_create().get_target(),
+                                    slide_index, geometry, surface)
+            if 0 <= slide_index - self.target_index() <= 1:
+                self.slide_changed()
+        return False
 
     def transition(self, direction=1):
         if direction == 0:
@@ -154,32 +902,49 @@ class MainWindow(gtk.Window):
                 self.current_slide_index + direction):
             self.current_slide_index += direction
             self.drawing_area.queue_draw()
+            self.slide_changed()
             return True
 
-        self.in_transition = 1
-        self.transition_alpha = 0
-        self.transition_next_index = self.current_slide_index + direction
-        gobject.timeout_add(TRANSITION_TIMEOUT, self.transition_callback)
+        if self.current_transition is None:
+            gobject.timeout_add(TRANSITION_TIMEOUT, self.transition_callback)
+        self.current_transition = Transition(self.current_slide_index,
+                                             self.current_slide_index + direction)
+        # render the target slide while the current one fades out
+        cr_width, cr_height = self.drawing_area.window.get_size()
+        if (self.current_transition.to_index, (cr_width, cr_height)) not in self.cache:
+            self.prefetcher.schedule([(self.current_transition.to_index,
+                                       cr_width, cr_height)])
+        self.slide_changed()
         return True
 
     def transition_callback(self):
-        if self.in_transition == -1 and self.transition_alpha < 0:
-            # fade finished
-            self.in_transition = 0  # 1 to fade in; -1 to fade out
-            self.transition_alpha = 0
-            self.transition_next_index = None
+        transition = self.current_transition
+        if transition is None:
             return False
 
-        if self.transition_alpha > 1.1:
-            # u-turn fade-out -> fade-in
-            self.in_transition = -self.in_transition
-            self.current_slide_index = self.transition_next_index
-        self.transition_alpha += TRANSITION_STEP * self.in_transition
+        self.current_slide_index = transition.slide_index()
+        if transition.finished():
+            self.current_transition = None
+            self.transition_stats.append(transition.stats())
+            del self.transition_stats[:-TRANSITION_STATS]
+            self.drawing_area.queue_draw()
+            return False
 
-        self.drawing_area.queue_draw()
+        if self._draw_pending:
+            # the last frame hasn't been drawn yet, don't pile up another one
+            transition.skipped_ticks += 1
+        else:
+            self._draw_pending = True
+            self.drawing_area.queue_draw()
         return True # return True to continue calling timeout
 
 def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--disk-cache', action='store_true', default=False,
+                      help='load rendered slides from the disk cache filled by '
+                           'prewarm.py and store new ones there')
+    options, args = parser.parse_args()
+    
     file0 = os.path.join(cairopresent.helpers.resources.EXAMPLE_PATH, 'thp', 'test.png')
     file1 = os.path.join(cairopresent.helpers.resources.EXAMPLE_PATH, 'thp', '161547780_81e990d7f7_o.jpg')
     file2 = os.path.join(cairopresent.helpers.resources.EXAMPLE_PATH, 'thp', '277386361_13b04e9d98_o.jpg')
@@ -190,12 +955,12 @@ def main():
     
     presentation = cairopresent.render.thp.Presentation(slides)
     
-    w = MainWindow(presentation)
+    w = MainWindow(presentation, disk_cache=options.disk_cache)
     gtk.main()
     
     presentation = cairopresent.render.lessig.Presentation(get_example('lessig.txt'))
     
-    w = MainWindow(presentation)
+    w = MainWindow(presentation, disk_cache=options.disk_cache)
     gtk.main()
 
 if __name__ == '__main__':
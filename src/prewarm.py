@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+
+"""Pre-renders a deck into the slide disk cache of the GTK GUI.
+
+Run this before a talk with the resolution of the projector, e.g.
+C{prewarm.py talk.txt -g 1024x768}, and start the GUI with C{--disk-cache},
+so the first pass through the deck doesn't have to render anything.
+"""
+
+import sys
+from optparse import OptionParser
+
+from cairopresent.helpers import assets, decks
+from cairopresent.helpers.diskcache import DiskCache, DEFAULT_DISK_CACHE_DIR, \
+                                           DEFAULT_DISK_CACHE_BYTES
+
+
+def parse_geometry(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def main():
+    parser = OptionParser(usage='%prog [options] DECK...')
+    parser.add_option('-g', '--geometry', action='append', default=[],
+                      help='WIDTHxHEIGHT, may be given several times [1024x768]')
+    parser.add_option('-d', '--directory', default=DEFAULT_DISK_CACHE_DIR,
+                      help='cache directory [%default]')
+    parser.add_option('-m', '--max-mb', type='int',
+                      default=DEFAULT_DISK_CACHE_BYTES // (1024 * 1024),
+                      help='size limit of the cache in MB [%default]')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('no deck given')
+
+    cache = DiskCache(options.directory, options.max_mb * 1024 * 1024)
+    geometries = map(parse_geometry, options.geometry) or [(1024, 768)]
+    for filename in args:
+        presentation = decks.load(filename)
+        report = assets.probe_assets(presentation)
+        if report.errors:
+            sys.stderr.write('%s: %d broken image(s):\n%s\n' % (
+                    filename, len(report.errors), report.format_errors()))
+        for geometry in geometries:
+            def progress(index, rendered):
+                sys.stderr.write({True: '+', False: '.', None: '!'}[rendered])
+                sys.stderr.flush()
+            sys.stderr.write('%s @ %dx%d: ' % ((filename,) + geometry))
+            rendered, errors = cache.prewarm(presentation, geometry, progress)
+            sys.stderr.write(' %d of %d slides rendered, %d failed\n' % (
+                    rendered, len(presentation.slides), len(errors)))
+            for index, error in errors:
+                sys.stderr.write('slide %d failed:\n%s' % (index + 1, error))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""Headless render service for batch export.
+
+Keeps the interpreter, fonts, decoded images and Pango layouts warm between
+export jobs. Jobs are JSON objects, one per line, read from stdin (default)
+or from clients of a Unix socket (C{--socket PATH}); each job gets a JSON
+reply on one line::
+
+    {"id": 1, "deck": "talk.txt", "format": "png", "geometry": [1024, 768],
+     "output": "out/talk"}
+    {"id": 1, "ok": true, "slides": 38, "errors": [],
+     "timing": {"load": 0.01, "render": 1.52, "total": 1.53}, ...}
+
+C{deck} is a deck file (see L{cairopresent.helpers.decks}) or an inline deck
+description; C{processes} is passed on to the export. When jobs are read
+from stdin, C{output} may not be C{"-"}, as stdout carries the replies.
+The images of a deck are probed when it is loaded and broken ones are
+listed in C{asset_errors} of the reply, before any slide is rendered. The
+commands
+C{{"command": "stats"}} and C{{"command": "quit"}} are understood as well.
+"""
+
+import json
+import os
+import SocketServer
+import sys
+import time
+import traceback
+from optparse import OptionParser
+
+from cairopresent.helpers import assets, decks, imageloader, layoutcache
+
+import export
+
+
+class RenderService(object):
+    """Runs export jobs, keeping parsed decks and all caches between jobs."""
+
+    def __init__(self, replies_on_stdout=False):
+        """Creates a render service.
+
+        @type  replies_on_stdout: bool
+        @param replies_on_stdout: Replies are written to stdout, so jobs
+                                  mustn't write their output there.
+        """
+        self.replies_on_stdout = replies_on_stdout
+        self.jobs = 0
+        self.started = time.time()
+        self._decks = {}    # path -> (mtime, presentation, asset report)
+
+    def presentation(self, deck):
+        """Returns the presentation for a deck path or description and the
+        L{assets.AssetReport} of its images; deck files are parsed and
+        probed again only when they change."""
+        if isinstance(deck, dict):
+            presentation = decks.from_spec(deck)
+            return presentation, assets.probe_assets(presentation)
+        mtime = os.stat(deck).st_mtime
+        cached = self._decks.get(deck)
+        if cached is None or cached[0] != mtime:
+            presentation = decks.load(deck)
+            cached = (mtime, presentation, assets.probe_assets(presentation))
+            self._decks[deck] = cached
+        return cached[1:]
+
+    def handle(self, job):
+        """Runs a job and returns the reply."""
+        command = job.get('command', 'render')
+        if command == 'stats':
+            return {'id': job.get('id'), 'ok': True, 'stats': self.stats()}
+        elif command == 'render':
+            return self.render(job)
+        return {'id': job.get('id'), 'ok': False,
+                'error': 'unknown command %r' % command}
+
+    def render(self, job):
+        format = job.get('format', 'png')
+        geometry = tuple(job.get('geometry', (1024, 768)))
+        output = job.get('output', 'slides.pdf' if format == 'pdf' else 'slides')
+        if output == '-' and self.replies_on_stdout:
+            return {'id': job.get('id'), 'ok': False,
+                    'error': 'output "-" would mix with the replies on stdout'}
+
+        start = time.time()
+        presentation, report = self.presentation(job['deck'])
+        loaded = time.time()
+
+        directory = os.path.dirname(output)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        exporter = export.create(presentation, format, output, geometry,
+                                 processes=job.get('processes', 1))
+        exporter.asset_report = report      # probed when the deck was loaded
+        errors = exporter.render()
+        done = time.time()
+
+        self.jobs += 1
+        return {'id': job.get('id'), 'ok': not errors,
+                'slides': len(presentation.slides),
+                'errors': [{'slide': index, 'traceback': error}
+                           for index, error in errors],
+                'asset_errors': [{'path': path, 'slides': indices, 'error': message}
+                                 for path, indices, message in report.errors],
+                'timing': {'load': loaded - start, 'render': done - loaded,
+                           'total': done - start},
+                'cache': {'images': imageloader.image_cache.stats(),
+                          'layouts': layoutcache.layout_cache.stats()}}
+
+    def stats(self):
+        return {'jobs': self.jobs, 'uptime': time.time() - self.started,
+                'decks': len(self._decks),
+                'images': imageloader.image_cache.stats(),
+                'decoders': imageloader.decoder_stats(),
+                'layouts': layoutcache.layout_cache.stats()}
+
+    def serve(self, rfile, wfile):
+        """Answers jobs read from C{rfile} on C{wfile} until EOF or C{quit}.
+
+        @return: C{False} if a client asked the service to quit.
+        """
+        for line in iter(rfile.readline, ''):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError, e:
+                reply = {'ok': False, 'error': 'invalid job: %s' % e}
+            else:
+                if job.get('command') == 'quit':
+                    self.write(wfile, {'id': job.get('id'), 'ok': True})
+                    return False
+                try:
+                    reply = self.handle(job)
+                except Exception:
+                    reply = {'id': job.get('id'), 'ok': False,
+                             'error': traceback.format_exc()}
+            self.write(wfile, reply)
+        return True
+
+    def write(self, wfile, reply):
+        wfile.write(json.dumps(reply) + '\n')
+        wfile.flush()
+
+
+class UnixServer(SocketServer.UnixStreamServer):
+    """Serves one client at a time, so all jobs share the caches."""
+
+    def __init__(self, path, service):
+        self.service = service
+        SocketServer.UnixStreamServer.__init__(self, path, ClientHandler)
+
+
+class ClientHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        if not self.server.service.serve(self.rfile, self.wfile):
+            self.server.quit = True
+
+
+def main():
+    parser = OptionParser(usage='%prog [--socket PATH]')
+    parser.add_option('-s', '--socket',
+                      help='listen on this Unix socket instead of stdin/stdout')
+    options, args = parser.parse_args()
+
+    if options.socket is None:
+        RenderService(replies_on_stdout=True).serve(sys.stdin, sys.stdout)
+        return
+
+    if os.path.exists(options.socket):
+        os.unlink(options.socket)
+    server = UnixServer(options.socket, RenderService())
+    server.quit = False
+    try:
+        while not server.quit:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(options.socket)
+
+if __name__ == '__main__':
+    main()
@@ -41,5 +41,5 @@ else:
         packages = ['cairopresent', 'cairopresent.helpers',
         'cairopresent.render'],
         data_files = [('share/pixmaps/cairopresent', ['../res/icon.png'])],
-        scripts = ['gtkgui.py', 'export.py']
+        scripts = ['gtkgui.py', 'export.py', 'renderd.py', 'prewarm.py']
         )